@@ -0,0 +1,62 @@
+""" Journal of which units and dates got new data
+
+    Importers (and the triggers behind the server's live inserts) append
+    a row per unit and date range that changed. The web renderer remembers
+    the last journal entry each artifact was rendered at, and only
+    re-renders artifacts whose inputs have changed since.
+
+    Sources:
+        ping_days       a unit pinged on a day it had not pinged before
+                        (trigger on unit_ping_days, see import_pings.py)
+        co2_readings    new readings (see import_co2_readings.py)
+"""
+
+def create_tables(db):
+    db.execute("""
+        create table if not exists change_journal (
+            seq         INTEGER primary key autoincrement,
+            source      TEXT,
+            unit_id     TEXT,
+            min_date    TEXT,
+            max_date    TEXT
+        );
+    """)
+
+def has_journal(db):
+    row = db.execute("""
+        select 1 from sqlite_master where type = 'table' and name = 'change_journal'
+    """).fetchone()
+    return row is not None
+
+def record(db, source, touched):
+    """ Record touched = {unit_id: (min_date, max_date)} """
+    db.executemany("""
+        insert into change_journal (source, unit_id, min_date, max_date)
+        values (?, ?, ?, ?)
+    """, [(source, unit_id, min_date, max_date)
+            for unit_id, (min_date, max_date) in touched.items()])
+
+def current_seq(db):
+    row = db.execute("select max(seq) from change_journal").fetchone()
+    return row[0] or 0
+
+def changes_since(db, source, seq, min_date=None):
+    """ Returns {unit_id: (min_date, max_date)} changed after seq
+
+        If min_date is given, only changes reaching min_date or later count.
+    """
+    sql = """
+        select unit_id, min(min_date), max(max_date)
+        from change_journal
+        where source = ? and seq > ?
+    """
+    params = [source, seq]
+    if min_date is not None:
+        sql += " and max_date >= ?"
+        params.append(min_date)
+    sql += " group by unit_id"
+    return {unit_id: (lo, hi) for unit_id, lo, hi in db.execute(sql, params)}
+
+def prune(db, seq):
+    """ Drop entries every reader has seen """
+    db.execute("delete from change_journal where seq <= ?", (seq,))
@@ -7,6 +7,8 @@ import math
 
 import warnings
 
+import deploy_intervals
+
 # Use a colorblind-friendly palette
 plt.style.use('tableau-colorblind10')
 
@@ -70,6 +72,8 @@ def argparser():
     parser.add_argument('--max-tier', type=int, required=False, default=None,
             help="Include only deployments with a 'tier' value <= this value")
     parser.add_argument('--recent-days', type=int, default=None)
+    parser.add_argument('--export-dir', type=str, default=None,
+            help="Read raw readings from Arrow files written by export_arrow.py, if there")
     parser.add_argument('--backend', type=str, default=None,
             help="Select MPL backend to output with. Select 'tikz' to use tikzplotlib")
     #parser.add_argument('--dpi', type=int, default="96")
@@ -77,6 +81,10 @@ def argparser():
     #parser.add_argument('--co2-max', type=int, default=None)
     return parser
 
+def epoch(ts):
+    """ Timestamp -> Unix time, as stored in co2_samples.ts """
+    return (pd.Timestamp(ts) - pd.Timestamp(0)) // pd.Timedelta(seconds=1)
+
 def select_deploys(db, xmin, xmax, min_tier, max_tier):
 
     sql = """
@@ -84,12 +92,15 @@ def select_deploys(db, xmin, xmax, min_tier, max_tier):
         select
             d.tier, d.site, d.unit_id, d.nickname, d.status,
             d.start_ts, d.end_ts,
-            min(c.date) as min_co2_date, max(c.date) as max_co2_date
+            date(min(c.ts), 'unixepoch') as min_co2_date,
+            date(max(c.ts), 'unixepoch') as max_co2_date
         from deploy_durations_tiered d
-        left join co2_readings c
-            on c.unit_id = d.unit_id
-            and (d.start_ts is null or d.start_ts <= c.date)
-            and (d.end_ts is null or c.date <= d.end_ts)
+        left join units u
+            on u.unit_id = d.unit_id
+        left join co2_samples c
+            on c.unit_key = u.unit_key
+            and (d.start_ts is null or c.ts >= cast(strftime('%s', d.start_ts) as integer))
+            and (d.end_ts is null or c.ts < cast(strftime('%s', d.end_ts, 'start of day', '+1 day') as integer))
         where {where_conds}
         group by
             tier, site, d.unit_id, d.nickname, d.status, d.start_ts, d.end_ts
@@ -98,34 +109,38 @@ def select_deploys(db, xmin, xmax, min_tier, max_tier):
         UNION ALL
         select
             null as tier, null as site,
-            c.unit_id,
+            u.unit_id,
             c.nickname, null as status,
             null as start_ts, null as end_ts,
-            min(c.date) as min_co2_date, max(c.date) as max_co2_date
-        from co2_readings c
+            date(min(c.ts), 'unixepoch') as min_co2_date,
+            date(max(c.ts), 'unixepoch') as max_co2_date
+        from co2_samples c
+        join units u
+            on u.unit_key = c.unit_key
         where {where_conds}
             and not exists (
                     select unit_id
-                    from deploy_durations_tiered where unit_id = c.unit_id
+                    from deploy_durations_tiered where unit_id = u.unit_id
                 )
 
         group by
-            c.unit_id, c.nickname
+            u.unit_id, c.nickname
 
         order by
-            tier desc, site, start_ts, d.nickname, c.nickname, c.unit_id, start_ts;
+            tier desc, site, start_ts, d.nickname, c.nickname, u.unit_id, start_ts;
     """
 
     where_conds = ["1"]
     params = []
 
+    # Whole days, from the start of xmin to the end of xmax
     if xmin is not None:
-        where_conds.append("c.date >= ?")
-        params.append(xmin)
+        where_conds.append("c.ts >= ?")
+        params.append(epoch(pd.Timestamp(xmin).normalize()))
 
     if xmax is not None:
-        where_conds.append("c.date <= ?")
-        params.append(xmax)
+        where_conds.append("c.ts < ?")
+        params.append(epoch(pd.Timestamp(xmax).normalize() + pd.Timedelta(days=1)))
 
     if min_tier is not None:
         where_conds.append("tier is not null and tier >= ?")
@@ -178,46 +193,6 @@ def determine_xlim(xmin, xmax, min_tier, max_tier, deploys):
 
     return xmin, xmax
 
-def deploys_overlap(ga, gb):
-
-    for _, a in ga.iterrows():
-        for _, b in gb.iterrows():
-
-            ast = a.start_ts; aen = a.end_ts
-            bst = b.start_ts; ben = b.end_ts
-
-            if ast and aen and bst and ben:     clear = aen <= bst or ben <= ast
-            elif ast and ben:                   clear = ben <= ast
-            elif aen and bst:                   clear = aen <= bst
-            else:                               clear = False
-
-            if not clear: return True
-    return False
-
-def group_deploys(deploys):
-    # First, group by site and unit
-    grouped = deploys.groupby(by=["tier","site","unit_id"], sort=False, dropna=False)
-
-    # Secong, combine (compress) different deployments at the same site,
-    # so long as they don't overlap
-    compressed = []
-    compress = None
-    for (tier, site, unit_id), group in grouped:
-        if compress is None:
-            compress = group
-        elif site == compress.iloc[-1].site and not deploys_overlap(compress, group):
-            compress = pd.concat([compress, group])
-        else:
-            ctuple = ((tier, site), compress)
-            compressed.append(ctuple)
-            compress = group
-    # Add last compress group
-    if compress is not None:
-        compress = ((tier, site), compress)
-        compressed.append(compress)
-
-    return compressed
-
 def set_date_ticks(ax, xmin, xmax):
 
     major_locator = mpl.dates.AutoDateLocator()
@@ -233,29 +208,227 @@ def set_date_ticks(ax, xmin, xmax):
 
     #ax.set_xlabel("Date")
 
-def select_co2_for_deploy(deploy_row):
+# Precomputed rollups (see ../python/import_co2_readings.py), coarsest first
+rollup_tables = [
+    (pd.Timedelta(days=1), "co2_rollup_daily"),
+    (pd.Timedelta(hours=1), "co2_rollup_hourly"),
+]
+
+def choose_rollup_table(db, bin_width):
+    """ Coarsest rollup table whose buckets evenly divide bin_width, if any """
+    if bin_width is None:
+        return None
+    for width, table in rollup_tables:
+        if bin_width >= width and bin_width % width == pd.Timedelta(0):
+            exists = db.execute("select 1 from sqlite_master where type='table' and name=?",
+                    (table,)).fetchone()
+            if exists:
+                return table
+    return None
+
+def select_co2_rollup(db, table, unit_ids, xmin, xmax):
     sql = """
-        select date || 'T' || time as co2_ts, *
-        from co2_readings c
-        where {where_conds}
-        order by date, time
-    """
+        select
+            bucket_ts as co2_ts, unit_id,
+            n, co2_mean, co2_std, co2_min, co2_max,
+            temp_n, temp_mean as temp
+        from {table}
+        where unit_id in ({units})
+            and bucket_ts >= ? and bucket_ts <= ?
+        order by unit_id, bucket_ts
+    """.format(table=table, units=", ".join("?" * len(unit_ids)))
+    params = list(unit_ids) + [
+            (xmin - pd.Timedelta(days=1)).date().isoformat(),
+            (xmax + pd.Timedelta(days=1)).date().isoformat(),
+    ]
+
+    co2 = pd.read_sql(sql, db, params=params)
+    co2['co2_ts'] = pd.to_datetime(co2['co2_ts'], format="%Y-%m-%dT%H:%M:%S", errors='coerce')
+    co2 = co2[~co2.co2_ts.isnull()]
+    co2 = co2.set_index('co2_ts', drop=False)
 
-    where_conds = ["unit_id = ?"]
-    params = [deploy_row.unit_id]
+    # An empty result comes back with object columns
+    for col in "n co2_mean co2_std co2_min co2_max temp_n temp".split():
+        co2[col] = pd.to_numeric(co2[col], errors='coerce')
 
-    if not pd.isnull(deploy_row.start_ts):
-        where_conds.append("date >= ?")
-        params.append(deploy_row.start_ts.isoformat())
+    return co2
 
-    if not pd.isnull(deploy_row.end_ts):
-        where_conds.append("date <= ?")
-        params.append(deploy_row.end_ts.isoformat())
+# Temperature readings of exactly this value mean the sensor maxed out
+temp_maxout_value = 85.0
 
-    sql = sql.format(where_conds = " and ".join(where_conds))
-    co2 = pd.read_sql(sql, db, params=params,
-            coerce_float=False, parse_dates=['co2_ts', 'date', 'time'])
+def select_co2_edge(db, unit_id, lo, hi, bucket_ts):
+    """ One rollup-style row for a unit's raw readings from lo to hi (inclusive)
+
+        Same aggregates as the rollup tables (see update_rollups in
+        import_co2_readings.py), labelled with the bucket_ts they fall in.
+        Returns None if there are no readings.
+    """
+    row_n = " + ".join("({} is not null)".format(c) for c in co2_cols)
+    row_sum = " + ".join("coalesce({}, 0)".format(c) for c in co2_cols)
+    sql = """
+        select
+            count(co2), avg(co2),
+            case when count(co2) > 1
+                then (sum(co2*co2) - sum(co2)*sum(co2)/count(co2)) / (count(co2)-1)
+            end,
+            min(co2), max(co2),
+            count(temp), avg(temp)
+        from (
+            select
+                ({row_sum}) * 1.0 / nullif({row_n}, 0) as co2,
+                case when temp != ? then temp end as temp
+            from co2_samples
+            where unit_key = (select unit_key from units where unit_id = ?)
+                and ts >= ? and ts <= ?
+        )
+    """.format(row_sum=row_sum, row_n=row_n)
+    n, co2_mean, co2_var, co2_min, co2_max, temp_n, temp = db.execute(sql,
+            (temp_maxout_value, unit_id, epoch(lo), epoch(hi))).fetchone()
+    if not n and not temp_n:
+        return None
+    return {
+        "co2_ts": bucket_ts, "unit_id": unit_id,
+        "n": n, "co2_mean": co2_mean,
+        "co2_std": math.sqrt(co2_var) if co2_var is not None and co2_var >= 0 else None,
+        "co2_min": co2_min, "co2_max": co2_max,
+        "temp_n": temp_n, "temp": temp,
+    }
+
+def split_rollup(db, unit_co2, unit_id, start, end, width, lo_ts, hi_ts):
+    """ A deployment's rollup rows, from start to end (inclusive, or open if NaT)
+
+        Only buckets that lie entirely within the deployment are taken
+        from the rollup. Buckets cut by its start or end would mix in
+        readings from before or after (e.g. the unit's next deployment),
+        so those are aggregated from the raw readings instead, limited
+        to the fetched range lo_ts to hi_ts.
+    """
+    ts = unit_co2.index.values
+    first_full = pd.Timestamp.min if pd.isnull(start) else start.ceil(width)
+    last_start = None if pd.isnull(end) else end.floor(width)
+
+    lo = np.searchsorted(ts, np.datetime64(first_full), side='left') if not pd.isnull(start) else 0
+    hi = np.searchsorted(ts, np.datetime64(last_start), side='left') if last_start is not None else len(ts)
+    parts = [unit_co2.iloc[lo:max(lo, hi)]]
+
+    # Partial buckets: (from, to, bucket)
+    edges = []
+    if last_start is not None and not pd.isnull(start) and start.floor(width) == last_start:
+        edges.append((start, end, last_start))
+    else:
+        if not pd.isnull(start) and start < first_full:
+            edges.append((start, first_full - pd.Timedelta(seconds=1), start.floor(width)))
+        if last_start is not None:
+            edges.append((last_start, end, last_start))
+
+    rows = []
+    for edge_lo, edge_hi, bucket_ts in edges:
+        edge_lo, edge_hi = max(edge_lo, lo_ts), min(edge_hi, hi_ts)
+        if edge_lo > edge_hi:
+            continue
+        row = select_co2_edge(db, unit_id, edge_lo, edge_hi, bucket_ts)
+        if row:
+            rows.append(row)
+    if not rows:
+        return parts[0]
+
+    edge_co2 = pd.DataFrame.from_records(rows, columns=unit_co2.columns)
+    edge_co2 = edge_co2.astype(unit_co2.dtypes.to_dict()).set_index('co2_ts', drop=False)
+    return pd.concat(parts + [edge_co2]).sort_index(kind='mergesort')
+
+def select_co2_for_deploys(db, deploys, xmin, xmax, bin_width=None, export_dir=None):
+    """ Fetch readings for all deployments with one query
+
+        Returns a dict of deploys index -> DataFrame of that deployment's
+        readings (massaged, indexed by timestamp).
+
+        If the data is going to be binned into bin_width buckets anyway,
+        reads from the coarsest rollup table that fits instead.
+        Rollup frames have 'n' and 'temp_n' columns with bucket counts.
+        Buckets cut by a deployment's start or end are made from the raw
+        readings in the deployment (see split_rollup).
+
+        Otherwise, if export_dir is given, reads the raw readings from the
+        Arrow files there (see export_arrow.py), falling back to the database.
+    """
+    unit_ids = sorted(deploys.unit_id.dropna().unique())
+
+    rollup_table = choose_rollup_table(db, bin_width)
+    co2 = None
+    if rollup_table:
+        co2 = select_co2_rollup(db, rollup_table, unit_ids, xmin, xmax)
+        width = dict((table, width) for width, table in rollup_tables)[rollup_table]
+    elif export_dir:
+        co2 = select_co2_export(export_dir, unit_ids, xmin, xmax)
+    if co2 is None:
+        co2 = select_co2_raw(db, unit_ids, xmin, xmax)
+
+    # Split by unit, then by deployment.
+    # Readings are sorted by unit and time, so each deployment is a slice
+    # found by binary search on that unit's timestamps.
+    by_deploy = {}
+    for unit_id, unit_co2 in co2.groupby('unit_id', sort=False):
+        ts = unit_co2.index.values
+        unit_deploys = deploys[deploys.unit_id == unit_id]
+
+        lo_ts = unit_deploys.start_ts.fillna(pd.Timestamp.min).values
+        hi_ts = unit_deploys.end_ts.fillna(pd.Timestamp.max).values
+        los = np.searchsorted(ts, lo_ts, side='left')
+        his = np.searchsorted(ts, hi_ts, side='right')
+
+        for j, lo, hi in zip(unit_deploys.index, los, his):
+            if rollup_table:
+                by_deploy[j] = split_rollup(db, unit_co2, unit_id,
+                        unit_deploys.start_ts[j], unit_deploys.end_ts[j], width,
+                        (xmin - pd.Timedelta(days=1)).normalize(),
+                        xmax.normalize() + pd.Timedelta(days=1) - pd.Timedelta(seconds=1))
+            else:
+                by_deploy[j] = unit_co2.iloc[lo:hi]
+
+    empty = co2.iloc[0:0]
+    return {j: by_deploy.get(j, empty) for j in deploys.index}
+
+def select_co2_raw(db, unit_ids, xmin, xmax):
+    # One range seek per unit on the (unit_key, ts) primary key, covering
+    # every deployment, but only the part that falls in the plot's x range
+    sql = """
+        select
+            c.ts as co2_ts, u.unit_id, c.nickname,
+            c.temp, c.flash_count, {co2_cols}
+        from units u
+        join co2_samples c
+            on c.unit_key = u.unit_key
+            and c.ts >= ? and c.ts < ?
+        where u.unit_id in ({units})
+        order by u.unit_id, c.ts
+    """.format(co2_cols=", ".join(co2_cols), units=", ".join("?" * len(unit_ids)))
+    params = [
+            epoch((xmin - pd.Timedelta(days=1)).normalize()),
+            epoch(xmax.normalize() + pd.Timedelta(days=1)),
+    ] + list(unit_ids)
+
+    co2 = pd.read_sql(sql, db, params=params, coerce_float=False)
+    co2['co2_ts'] = pd.to_datetime(co2['co2_ts'], unit='s')
+    co2 = massage_co2_data(co2)
+    return co2
 
+# Columns the plots use from exported readings
+export_columns = ["unit_id", "co2_ts", "temp", "co2_mean"]
+
+def select_co2_export(export_dir, unit_ids, xmin, xmax):
+    # Exported readings are already massaged. Files are memory-mapped,
+    # and only the columns used here are read from them.
+    import export_arrow
+    min_date = (xmin - pd.Timedelta(days=1)).normalize()
+    max_date = xmax.normalize() + pd.Timedelta(days=1)
+    co2 = export_arrow.read_months(export_dir, "co2_readings", unit_ids,
+            min_date.date().isoformat(), max_date.date().isoformat(), export_columns)
+    if co2 is None:
+        return None
+
+    # Same date range as select_co2_raw
+    co2 = co2[(co2.co2_ts >= min_date) & (co2.co2_ts < max_date)]
+    co2 = co2.set_index('co2_ts', drop=False)
     return co2
 
 def massage_co2_data(co2):
@@ -266,7 +439,7 @@ def massage_co2_data(co2):
     co2 = co2[~co2.co2_ts.isnull()]
 
     # Use timestamp as the index
-    co2.set_index('co2_ts', drop=False, inplace=True)
+    co2 = co2.set_index('co2_ts', drop=False)
 
     # Run through each numeric column and sets non-numeric values to NaN
     # (errors='coerce' -> coerce to NaN)
@@ -308,15 +481,27 @@ def calculate_bin_width(ax):
     # print("Data bin size: Target on-page width {} pts = {}. Normalizing to {}.".format(bin_size_pts, bin_width, normalized))
     return normalized
 
+def weighted_resample(means, counts, bin_width):
+    counts = counts.where(means.notnull(), 0)
+    sums = (means.fillna(0) * counts).resample(bin_width, origin='start_day').sum()
+    totals = counts.resample(bin_width, origin='start_day').sum()
+    return sums / totals.where(totals > 0)
+
 def resample_data(co2, bin_width):
     co2_series = co2['co2_mean']
     temp_series = co2['temp']
 
+    if 'n' in co2:
+        # Rollup buckets (maxed-out temps already left out):
+        # weight each bucket's mean by its count
+        co2_series = weighted_resample(co2_series, co2['n'], bin_width)
+        temp_series = weighted_resample(temp_series, co2['temp_n'], bin_width)
+        return co2_series, temp_series
+
     # Strip out outliner max temp values
     # Note: This produces a ton of FutureWarnings
     # See https://stackoverflow.com/a/46721064
     warnings.simplefilter(action='ignore', category=FutureWarning)
-    temp_maxout_value = 85.0
     temp_series = temp_series.loc[temp_series != temp_maxout_value]
 
     if bin_width != None:
@@ -414,14 +599,15 @@ def draw_site_label(ax, site_label):
             **site_label_style)
     return t
 
-def build_plot(db, xmin=None, xmax=None, recent_days=None, min_tier=None, max_tier=None, co2_max=None):
+def build_plot(db, xmin=None, xmax=None, recent_days=None, min_tier=None, max_tier=None, co2_max=None,
+        export_dir=None):
 
     if recent_days and not xmin:
         xmin = pd.Timestamp.now().normalize() - pd.Timedelta(days=recent_days)
         xmin = xmin.isoformat()
 
     deploys = select_deploys(db, xmin, xmax, min_tier, max_tier)
-    grouped = group_deploys(deploys)
+    grouped = deploy_intervals.group_deploys(deploys)
     num_groups = len(grouped)
 
     # Initialize figure
@@ -449,6 +635,8 @@ def build_plot(db, xmin=None, xmax=None, recent_days=None, min_tier=None, max_ti
 
     bin_width = calculate_bin_width(axes[-1])
 
+    co2_by_deploy = select_co2_for_deploys(db, deploys, xmin, xmax, bin_width, export_dir)
+
     # Main loop: each deployment group -> subplot
     for i, (group_name, group) in enumerate(grouped):
         # Current subplot axes
@@ -483,8 +671,7 @@ def build_plot(db, xmin=None, xmax=None, recent_days=None, min_tier=None, max_ti
 
         for j, deploy_row in group.iterrows():
 
-            co2 = select_co2_for_deploy(deploy_row)
-            co2 = massage_co2_data(co2)
+            co2 = co2_by_deploy[j]
             co2_series, temp_series = resample_data(co2, bin_width)
             draw_co2(co2_ax, co2_fill_ax, co2_series, deploy_row.status)
             draw_temp(temp_ax, temp_series)
@@ -0,0 +1,87 @@
+""" Deployment interval helpers shared by the tiered plot scripts
+
+    Deployments are grouped into plot rows by tier, site, and unit.
+    Groups at the same site are then combined into one row,
+    so long as none of their deployments overlap in time.
+"""
+
+import numpy as np
+import pandas as pd
+
+def as_float_ns(timestamps, fill):
+    """ Timestamp column -> float64 nanoseconds, with fill for NaT """
+    ts = pd.to_datetime(pd.Series(timestamps))
+    values = ts.values.astype("datetime64[ns]").astype("int64").astype("float64")
+    values[ts.isnull().values] = fill
+    return values
+
+def intervals_overlap(a_starts, a_ends, b_starts, b_ends):
+    """ True if any interval in a overlaps any interval in b
+
+        Intervals are half-open: touching end to start is not an overlap.
+        Open starts and ends should be given as -inf and +inf.
+
+        Sorts a by start and takes a running max of its ends. An interval
+        from b overlaps something in a exactly when the largest end among
+        the a intervals starting before b ends is after b starts.
+    """
+    if not len(a_starts) or not len(b_starts):
+        return False
+
+    order = np.argsort(a_starts, kind="stable")
+    a_starts = a_starts[order]
+    a_max_ends = np.maximum.accumulate(a_ends[order])
+
+    n_before = np.searchsorted(a_starts, b_ends, side="left")
+    has_before = n_before > 0
+    max_end_before = a_max_ends[np.maximum(n_before - 1, 0)]
+    return bool((has_before & (max_end_before > b_starts)).any())
+
+def group_deploys(deploys):
+    """ Group deployments into plot rows
+
+        Returns a list of ((tier, site), DataFrame) with the rows in each
+        DataFrame keeping their original index.
+    """
+    if not len(deploys):
+        return []
+
+    # First, group by site and unit.
+    # ngroup numbers groups in order of first appearance.
+    codes = deploys.groupby(by=["tier","site","unit_id"], sort=False, dropna=False) \
+            .ngroup().values
+    order = np.argsort(codes, kind="stable")
+    splits = np.flatnonzero(np.diff(codes[order])) + 1
+    groups = np.split(order, splits)
+
+    # No start or end date means the deployment is open on that side
+    starts = as_float_ns(deploys.start_ts, -np.inf)
+    ends = as_float_ns(deploys.end_ts, np.inf)
+    sites = deploys.site.values
+
+    # Second, combine (compress) different deployments at the same site,
+    # so long as they don't overlap
+    compressed = []
+    compress = None
+    for positions in groups:
+        site = sites[positions[0]]
+        if compress is not None \
+                and not pd.isnull(site) and site == sites[compress[0]] \
+                and not intervals_overlap(starts[compress], ends[compress],
+                        starts[positions], ends[positions]):
+            compress = np.concatenate([compress, positions])
+        else:
+            if compress is not None:
+                compressed.append(compress)
+            compress = positions
+    # Add last compress group
+    if compress is not None:
+        compressed.append(compress)
+
+    # Reorder once, so each group is a cheap contiguous slice
+    ordered = deploys.iloc[np.concatenate(compressed)]
+    tiers = ordered.tier.values
+    sites = ordered.site.values
+    bounds = np.cumsum([0] + [len(positions) for positions in compressed])
+    return [((tiers[a], sites[a]), ordered.iloc[a:b])
+            for a, b in zip(bounds[:-1], bounds[1:])]
@@ -0,0 +1,257 @@
+""" Export cleaned, typed readings and pings to Arrow files
+
+    Writes one file per unit and month:
+
+        <outdir>/<table>/unit_id=<unit_id>/<YYYY-MM>.arrow
+
+    Files are Arrow IPC ("Feather v2"), uncompressed, so readers can
+    memory-map them and only page in the columns they use
+    (see read_months, and --export-dir in co2_plot_tiered.py).
+    pyarrow.dataset and other Arrow/Parquet tools can read the directory
+    as a dataset partitioned by unit_id.
+
+    Rows are cleaned the same way the plot scripts clean them: timestamps
+    are parsed, rows without a valid timestamp are dropped, and numbers
+    are typed. CO2 readings also get precomputed co2_mean and co2_std.
+
+    Exports are incremental. Each partition's row count and max key are
+    kept in <outdir>/export_state.json, and only partitions that changed
+    since the last export are written again.
+"""
+
+import calendar
+import json
+import os
+import re
+import sqlite3
+import sys
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+STATE_FILE = "export_state.json"
+
+co2_cols = ["co2_{:02d}".format(i) for i in range(1,11)]
+
+# Partition names become paths, so only these get exported
+unit_id_re = re.compile(r"^[A-Za-z0-9_-][A-Za-z0-9_.-]*$")
+month_re = re.compile(r"^[0-9]{4}-[0-9]{2}$")
+
+def as_int(series):
+    """ Numbers or NULL -> nullable Int64 """
+    return pd.to_numeric(series, errors='coerce').round().astype("Int64")
+
+def as_float(series):
+    return pd.to_numeric(series, errors='coerce').astype("float64")
+
+def clean_co2_readings(rows):
+    co2 = pd.DataFrame.from_records(rows,
+            columns=["unit_id", "nickname", "co2_ts", "temp", "flash_count"] + co2_cols)
+
+    # Stored as Unix time, and always valid (see import_co2_readings.py)
+    co2["co2_ts"] = pd.to_datetime(co2.co2_ts, unit='s')
+
+    co2["temp"] = as_float(co2.temp)
+    co2["flash_count"] = as_int(co2.flash_count)
+    values = co2[co2_cols].apply(as_float)
+    for col in co2_cols:
+        co2[col] = as_int(values[col])
+
+    co2["co2_mean"] = values.mean(axis=1)
+    co2["co2_std"] = values.std(axis=1)
+    return co2
+
+def clean_pings(rows):
+    pings = pd.DataFrame.from_records(rows,
+            columns=["unit_id", "nickname", "ping_date", "ping_time", "rssi_raw", "rssi_dbm"])
+
+    pings.insert(2, "ping_ts", pd.to_datetime(pings.ping_date + "T" + pings.ping_time,
+            errors='coerce'))
+    pings = pings[~pings.ping_ts.isnull()].drop(columns=["ping_date", "ping_time"])
+
+    pings["rssi_raw"] = as_int(pings.rssi_raw)
+    pings["rssi_dbm"] = as_int(pings.rssi_dbm)
+    return pings
+
+def month_to_epoch(month):
+    return calendar.timegm((int(month[:4]), int(month[5:7]), 1, 0, 0, 0))
+
+# Table -> (
+#   partition signature query: unit_id, YYYY-MM, row count, max key,
+#   query for one partition's rows in time order,
+#   month -> query bounds,
+#   clean function)
+#
+# Rows are only ever added (or the table rebuilt),
+# so a partition with the same signature has the same rows.
+exports = {
+    "co2_readings": ("""
+            select u.unit_id, strftime('%Y-%m', c.ts, 'unixepoch') as month, count(*), max(c.ts)
+            from co2_samples c
+            join units u on u.unit_key = c.unit_key
+            group by c.unit_key, month
+        """, """
+            select u.unit_id, c.nickname, c.ts, c.temp, c.flash_count, {co2_cols}
+            from units u
+            join co2_samples c on c.unit_key = u.unit_key
+            where u.unit_id = ? and c.ts >= ? and c.ts < ?
+            order by c.ts
+        """.format(co2_cols=", ".join("c." + col for col in co2_cols)),
+        lambda month: (month_to_epoch(month), month_to_epoch(next_month(month))),
+        clean_co2_readings),
+    "pings": ("""
+            select unit_id, substr(ping_date, 1, 7) as month, count(*), max(rowid)
+            from pings
+            where unit_id is not null and ping_date is not null
+            group by unit_id, month
+        """, """
+            select unit_id, nickname, ping_date, ping_time, rssi_raw, rssi_dbm
+            from pings
+            where unit_id = ? and ping_date >= ? and ping_date < ?
+            order by ping_date, ping_time
+        """,
+        lambda month: (month, next_month(month)),
+        clean_pings),
+}
+
+def partition_path(outdir, table, unit_id, month):
+    return os.path.join(outdir, table, "unit_id=" + unit_id, month + ".arrow")
+
+def next_month(month):
+    year, mon = int(month[:4]), int(month[5:7])
+    return "{:04d}-{:02d}".format(year + mon // 12, mon % 12 + 1)
+
+def months_between(min_month, max_month):
+    months = []
+    month = min_month
+    while month <= max_month:
+        months.append(month)
+        month = next_month(month)
+    return months
+
+def partition_signatures(db, table):
+    """ Returns {"unit_id/YYYY-MM": [row count, max key]} """
+    sql = exports[table][0]
+    return {unit_id + "/" + month: [n, max_key]
+            for unit_id, month, n, max_key in db.execute(sql)
+            if unit_id_re.match(unit_id) and month_re.match(month)}
+
+def write_partition(db, outdir, table, unit_id, month):
+    _, select, bounds, clean = exports[table]
+    rows = db.execute(select, (unit_id,) + bounds(month)).fetchall()
+    frame = clean(rows)
+
+    path = partition_path(outdir, table, unit_id, month)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmppath = path + ".tmp"
+    feather.write_feather(pa.Table.from_pandas(frame, preserve_index=False),
+            tmppath, compression="uncompressed")
+    os.replace(tmppath, path)
+    return len(frame)
+
+def remove_partition(outdir, table, unit_id, month):
+    path = partition_path(outdir, table, unit_id, month)
+    if os.path.exists(path):
+        os.remove(path)
+    try:
+        os.rmdir(os.path.dirname(path))
+    except OSError:
+        pass
+
+def load_state(outdir):
+    path = os.path.join(outdir, STATE_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_state(outdir, state):
+    path = os.path.join(outdir, STATE_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+def export_table(db, outdir, table, old_signatures, force=False):
+    """ Write the changed partitions of one table. Returns new signatures. """
+    # Read everything in one snapshot
+    db.execute("begin")
+    try:
+        signatures = partition_signatures(db, table)
+        written = rows = 0
+        for key, sig in sorted(signatures.items()):
+            unit_id, month = key.split("/")
+            if force or old_signatures.get(key) != sig \
+                    or not os.path.exists(partition_path(outdir, table, unit_id, month)):
+                rows += write_partition(db, outdir, table, unit_id, month)
+                written += 1
+    finally:
+        db.execute("commit")
+
+    removed = 0
+    for key in old_signatures:
+        if key not in signatures:
+            remove_partition(outdir, table, *key.split("/"))
+            removed += 1
+
+    print("## export {}: wrote {} of {} partitions ({} rows), removed {}".format(
+        table, written, len(signatures), rows, removed), file=sys.stderr)
+    return signatures
+
+def export_all(db, outdir, tables=None, force=False):
+    os.makedirs(outdir, exist_ok=True)
+    state = load_state(outdir)
+    for table in tables or list(exports):
+        try:
+            state[table] = export_table(db, outdir, table, state.get(table, {}), force)
+        except sqlite3.OperationalError as e:
+            print("## export {}: skipped: {}".format(table, e), file=sys.stderr)
+            continue
+        # Save as we go, so finished tables are not exported again
+        save_state(outdir, state)
+
+def read_months(outdir, table, unit_ids, min_date, max_date, columns=None):
+    """ Read exported rows for units and dates, memory-mapped
+
+        Returns a DataFrame of every row in the months from min_date to
+        max_date (ISO dates), sorted by unit and time,
+        or None if nothing for them has been exported to outdir.
+        Only the given columns are read from the files.
+    """
+    state = load_state(outdir)
+    if table not in state:
+        return None
+
+    tables = []
+    for unit_id in unit_ids:
+        for month in months_between(min_date[:7], max_date[:7]):
+            if unit_id + "/" + month not in state[table]:
+                continue
+            path = partition_path(outdir, table, unit_id, month)
+            tables.append(feather.read_table(path, columns=columns, memory_map=True))
+
+    if not tables:
+        return None
+    return pa.concat_tables(tables).to_pandas()
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser(description="Export cleaned data to Arrow files by unit and month")
+    parser.add_argument('dbfile', type=str)
+    parser.add_argument('outdir', type=str)
+    parser.add_argument('tables', type=str, nargs='*',
+            help="Tables to export (default all): {}".format(", ".join(exports)))
+    parser.add_argument('--force', action='store_true',
+            help="Rewrite every partition, even if unchanged (e.g. after code changes)")
+
+    args = parser.parse_args()
+
+    unknown = [t for t in args.tables if t not in exports]
+    if unknown:
+        parser.error("unknown tables: {}".format(", ".join(unknown)))
+
+    # Autocommit mode: transactions are managed explicitly with begin/commit
+    db = sqlite3.connect(args.dbfile, isolation_level=None)
+    export_all(db, args.outdir, args.tables, args.force)
+    db.close()
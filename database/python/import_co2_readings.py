@@ -0,0 +1,413 @@
+""" Incremental import of CO2 readings into the co2_samples table
+
+    Only bytes added to each readings-*.tsv file since the last run are
+    read. Each line is filtered and its fields coerced to numbers or NULL
+    once, as it is parsed, and the new rows are inserted in one transaction.
+
+    Readings are stored typed: the time as an integer Unix timestamp
+    (UTC seconds), the unit as an integer key into the units table, and
+    sensor values as REAL/INTEGER or NULL. The table is keyed (and
+    clustered) on (unit_key, ts), so range queries are index seeks.
+    A reading repeating a unit's timestamp is dropped as a duplicate.
+    The co2_readings view shows the readings with the old
+    unit_id/date/time text columns, for ad-hoc queries.
+
+    Hourly and daily rollup tables (co2_rollup_hourly, co2_rollup_daily)
+    are kept up to date in the same transaction, by recomputing only the
+    days that received new readings, and the days are recorded in the
+    change journal for the web renderer.
+"""
+
+import calendar
+import datetime
+import math
+import re
+import sys
+
+import change_journal
+import import_offsets
+
+TABLE = "co2_readings"
+
+co2_cols = ["co2_{:02d}".format(i) for i in range(1,11)]
+columns = ["unit_id", "nickname", "date", "time", "temp", "flash_count"] + co2_cols
+
+# Lines matching any of these are dropped (name, test)
+filters = [
+    # Lines with non-printing characters (corrupt files)
+    ("non-printing", re.compile(r"[^\x21-\x7e \t\n\r\f\v]").search),
+    # Old format before the unit id was first, only test data
+    ("no-unit-id", lambda line: not line.startswith("co2unit-")),
+    # Readings with no RTC time, only a few readings from lab
+    ("1970", lambda line: "1970-" in line),
+]
+
+def create_tables(db):
+    db.execute("""
+        create table if not exists units (
+            unit_key    INTEGER primary key,
+            unit_id     TEXT not null unique
+        );
+    """)
+    db.execute("""
+        create table if not exists co2_samples (
+            unit_key    INTEGER not null,
+            ts          INTEGER not null,   -- Unix time (UTC seconds)
+            nickname    TEXT,
+            temp        REAL,
+            flash_count INTEGER,
+            co2_01      INTEGER,
+            co2_02      INTEGER,
+            co2_03      INTEGER,
+            co2_04      INTEGER,
+            co2_05      INTEGER,
+            co2_06      INTEGER,
+            co2_07      INTEGER,
+            co2_08      INTEGER,
+            co2_09      INTEGER,
+            co2_10      INTEGER,
+            primary key (unit_key, ts)
+        ) without rowid;
+    """)
+    migrate_old_table(db)
+    db.execute("""
+        create view if not exists co2_readings as
+        select
+            u.unit_id, c.nickname,
+            strftime('%Y-%m-%d', c.ts, 'unixepoch') as date,
+            strftime('%H:%M:%S', c.ts, 'unixepoch') as time,
+            c.temp, c.flash_count, {co2_cols}
+        from co2_samples c
+        join units u on u.unit_key = c.unit_key
+    """.format(co2_cols=", ".join("c." + c for c in co2_cols)))
+    create_rollup_tables(db)
+    change_journal.create_tables(db)
+
+def is_set_up(db):
+    """ True once the importer has made (or migrated) the typed tables
+
+        Checked on the schema alone: a first import with no readings files
+        sets up the tables but records no offsets.
+    """
+    return object_type(db, "co2_samples") == "table" \
+            and object_type(db, "units") == "table" \
+            and object_type(db, "co2_readings") != "table"
+
+def object_type(db, name):
+    row = db.execute("select type from sqlite_master where name = ?", (name,)).fetchone()
+    return row[0] if row else None
+
+def drop_tables(db):
+    if object_type(db, "co2_readings") == "view":
+        db.execute("drop view co2_readings")
+    db.execute("drop table if exists co2_readings")
+    db.execute("drop table if exists co2_samples")
+    for table in rollups:
+        db.execute("drop table if exists {}".format(table))
+
+def migrate_old_table(db):
+    """ Copy readings from the old text-based co2_readings table, once
+
+        The offsets recorded for the old table stay valid.
+    """
+    if object_type(db, "co2_readings") != "table":
+        return
+
+    # Only real, finite numbers: older imports left some 'None' strings
+    # behind, and numeric columns turned text such as '1e400' into infinity
+    def number(col):
+        return "case when typeof({col}) = 'integer'" \
+                " or (typeof({col}) = 'real' and abs({col}) < 9e999) then {col} end".format(col=col)
+
+    db.execute("""
+        insert or ignore into units (unit_id)
+        select distinct unit_id from co2_readings where unit_id is not null
+    """)
+    # Timestamps that do not convert back to the same text were not valid
+    db.execute("""
+        insert or ignore into co2_samples
+        select
+            u.unit_key, c.ts, case when c.nickname glob '*NICK' then null else c.nickname end,
+            {numbers}
+        from (
+            select *, cast(strftime('%s', date || ' ' || time) as integer) as ts
+            from co2_readings
+        ) c
+        join units u on u.unit_id = c.unit_id
+        where strftime('%Y-%m-%d %H:%M:%S', c.ts, 'unixepoch') = c.date || ' ' || c.time
+        order by u.unit_key, c.ts
+    """.format(numbers=", ".join(number("c." + col) for col in ["temp", "flash_count"] + co2_cols)))
+    db.execute("drop table co2_readings")
+
+    # Recompute rollups from the copied readings
+    touched = dict((unit_id, (lo, hi)) for unit_id, lo, hi in db.execute("""
+        select unit_id, date(min(ts), 'unixepoch'), date(max(ts), 'unixepoch')
+        from co2_samples join units using (unit_key)
+        group by unit_key
+    """))
+    create_rollup_tables(db)
+    update_rollups(db, touched)
+    change_journal.create_tables(db)
+    change_journal.record(db, TABLE, touched)
+
+# Rollups: table name -> strftime format for the bucket timestamp
+rollups = {
+    "co2_rollup_hourly": "%Y-%m-%dT%H:00:00",
+    "co2_rollup_daily": "%Y-%m-%dT00:00:00",
+}
+
+# Temperature readings of exactly this value mean the sensor maxed out
+temp_maxout_value = 85.0
+
+def create_rollup_tables(db):
+    for table in rollups:
+        db.execute("""
+            create table if not exists {table} (
+                unit_id     TEXT,
+                bucket_ts   TEXT,
+                n           INTEGER,    -- readings with a co2 value
+                co2_mean    REAL,       -- of each reading's mean over co2_01..co2_10
+                co2_std     REAL,
+                co2_min     REAL,
+                co2_max     REAL,
+                temp_n      INTEGER,
+                temp_mean   REAL,
+                temp_min    REAL,
+                temp_max    REAL,
+                primary key (unit_id, bucket_ts)
+            );
+        """.format(table=table))
+
+def update_rollups(db, touched):
+    """ Recompute rollup buckets for touched = {unit_id: (min_date, max_date)} """
+    # Not all SQLite builds have math functions
+    db.create_function("sqrt", 1, lambda x: math.sqrt(x) if x is not None and x >= 0 else None)
+
+    row_n = " + ".join("({} is not null)".format(c) for c in co2_cols)
+    row_sum = " + ".join("coalesce({}, 0)".format(c) for c in co2_cols)
+    keys = unit_keys(db, touched)
+
+    for table, bucket_fmt in rollups.items():
+        for unit_id, (min_date, max_date) in touched.items():
+            # Bucket timestamps on max_date are "max_date T...", and 'T' < 'U'
+            db.execute("""
+                delete from {table}
+                where unit_id = ? and bucket_ts >= ? and bucket_ts < ?
+            """.format(table=table), (unit_id, min_date, max_date + "U"))
+
+            db.execute("""
+                insert into {table}
+                select
+                    ?, bucket_ts,
+                    count(co2), avg(co2),
+                    case when count(co2) > 1
+                        then sqrt((sum(co2*co2) - sum(co2)*sum(co2)/count(co2)) / (count(co2)-1))
+                    end,
+                    min(co2), max(co2),
+                    count(temp), avg(temp), min(temp), max(temp)
+                from (
+                    select
+                        strftime('{bucket_fmt}', ts, 'unixepoch') as bucket_ts,
+                        ({row_sum}) * 1.0 / nullif({row_n}, 0) as co2,
+                        case when temp != ? then temp end as temp
+                    from co2_samples
+                    where unit_key = ? and ts >= ? and ts < ?
+                )
+                group by bucket_ts
+            """.format(table=table, bucket_fmt=bucket_fmt, row_sum=row_sum, row_n=row_n),
+                (unit_id, temp_maxout_value, keys[unit_id],
+                    date_to_epoch(min_date), date_to_epoch(max_date) + 24 * 60 * 60))
+
+epoch_start = datetime.datetime(1970, 1, 1)
+
+def to_epoch(date, time):
+    """ "2020-07-01", "00:30:00" -> Unix time, or None if not a valid time """
+    try:
+        dt = datetime.datetime.strptime(date + " " + time, "%Y-%m-%d %H:%M:%S")
+    except (TypeError, ValueError):
+        return None
+    return calendar.timegm(dt.timetuple())
+
+def date_to_epoch(date):
+    return calendar.timegm(datetime.datetime.strptime(date, "%Y-%m-%d").timetuple())
+
+def epoch_to_date(ts):
+    return (epoch_start + datetime.timedelta(seconds=ts)).date().isoformat()
+
+def unit_keys(db, unit_ids):
+    """ Returns {unit_id: unit_key}, adding units not seen before """
+    db.executemany("insert or ignore into units (unit_id) values (?)",
+            [(unit_id,) for unit_id in unit_ids])
+    keys = {}
+    for unit_id in unit_ids:
+        row = db.execute("select unit_key from units where unit_id = ?", (unit_id,)).fetchone()
+        keys[unit_id] = row[0]
+    return keys
+
+# Out of range for SQLite INTEGER
+int_max = 2**63 - 1
+
+def to_number(val, cast=int):
+    """ Text field -> number, or None
+
+        Integer fields keep values that are not whole numbers as REAL,
+        as the old untyped table did. Infinite and NaN values are NULL.
+    """
+    # "None" and incomplete values (e.g. "No" from a cut-off line) are NULL
+    if val is None or val == "" or val.startswith("N"):
+        return None
+    try:
+        num = float(val)
+    except (ValueError, OverflowError):
+        return None
+    if not math.isfinite(num):
+        return None
+    if cast is not int:
+        return cast(num)
+    try:
+        # Exact, even for digit strings too long for a float
+        whole = int(val)
+    except ValueError:
+        if not num.is_integer():
+            return num
+        whole = int(num)
+    return whole if abs(whole) <= int_max else num
+
+def parse_line(line):
+    """ Returns [unit_id, ts, nickname, temp, flash_count, co2_01, ...],
+        or None if the line has no valid time
+    """
+    fields = line.split("\t")
+    # Missing fields are NULL, extra fields are ignored
+    fields += [None] * (len(columns) - len(fields))
+    unit_id, nickname, date, time, temp, flash_count = fields[:6]
+
+    ts = to_epoch(date, time)
+    if ts is None:
+        return None
+
+    # Misconfigured nicknames
+    if nickname is not None and nickname.endswith("NICK"):
+        nickname = None
+
+    return [unit_id, ts, nickname,
+            to_number(temp, float), to_number(flash_count)] \
+            + [to_number(v) for v in fields[6:len(columns)]]
+
+def parse_lines(lines, filter_counts):
+    """ Filter and parse lines, counting how many each filter drops """
+    rows = []
+    for line in lines:
+        drop = False
+        for name, test in filters:
+            if test(line):
+                filter_counts[name] = filter_counts.get(name, 0) + 1
+                drop = True
+        if drop:
+            continue
+        row = parse_line(line)
+        if row is None:
+            filter_counts["bad-time"] = filter_counts.get("bad-time", 0) + 1
+            continue
+        rows.append(row)
+    return rows
+
+def insert_rows(db, rows, filter_counts):
+    """ Insert parsed rows. Returns the number added. """
+    keys = unit_keys(db, set(row[0] for row in rows))
+    placeholders = ", ".join("?" * (len(columns) - 1))
+    cur = db.executemany("insert or ignore into co2_samples values ({})".format(placeholders),
+            ([keys[row[0]]] + row[1:] for row in rows))
+    added = max(cur.rowcount, 0)
+    filter_counts["duplicate"] = filter_counts.get("duplicate", 0) + len(rows) - added
+    return added
+
+def add_touched(touched, rows):
+    # Track times, and only turn the first and last into dates
+    spans = {}
+    for row in rows:
+        unit_id, ts = row[0], row[1]
+        if unit_id in spans:
+            min_ts, max_ts = spans[unit_id]
+            spans[unit_id] = (min(min_ts, ts), max(max_ts, ts))
+        else:
+            spans[unit_id] = (ts, ts)
+
+    for unit_id, (min_ts, max_ts) in spans.items():
+        min_date, max_date = epoch_to_date(min_ts), epoch_to_date(max_ts)
+        if unit_id in touched:
+            old_min, old_max = touched[unit_id]
+            touched[unit_id] = (min(old_min, min_date), max(old_max, max_date))
+        else:
+            touched[unit_id] = (min_date, max_date)
+
+def import_file(db, path, final=False, filter_counts=None, touched=None):
+    """ Import new lines from one file, within the caller's transaction
+
+        Returns the number of rows added.
+        Rollups are updated right away, unless a touched dict is passed to
+        collect the dates to update later (see update_rollups).
+        Also used by the server to import readings as they are pushed.
+    """
+    if filter_counts is None:
+        filter_counts = {}
+
+    offset = import_offsets.get_offset(db, TABLE, path)
+    lines, new_offset = import_offsets.read_new_lines(path, offset, final)
+    if new_offset == offset:
+        return 0
+
+    rows = parse_lines(lines, filter_counts)
+    added = insert_rows(db, rows, filter_counts)
+    import_offsets.set_offset(db, TABLE, path, new_offset)
+
+    if touched is None:
+        file_touched = {}
+        add_touched(file_touched, rows)
+        update_rollups(db, file_touched)
+        change_journal.record(db, TABLE, file_touched)
+    else:
+        add_touched(touched, rows)
+
+    return added
+
+def import_readings(db, paths):
+    filter_counts = {}
+    touched = {}
+    added = 0
+
+    db.execute("begin immediate")
+    try:
+        if not import_offsets.has_offsets(db, TABLE) and not is_set_up(db):
+            # Table built by the old drop-and-reload import (or not at all).
+            # Start over once.
+            drop_tables(db)
+        create_tables(db)
+
+        for path, final in import_offsets.final_files(paths):
+            added += import_file(db, path, final, filter_counts, touched)
+
+        update_rollups(db, touched)
+        change_journal.record(db, TABLE, touched)
+
+        db.execute("commit")
+    except:
+        db.execute("rollback")
+        raise
+
+    for name in [name for name, _ in filters] + ["bad-time", "duplicate"]:
+        print("## co2 filter {:>12} dropped {:5d} new lines".format(name, filter_counts.get(name, 0)), file=sys.stderr)
+    print("## co2 readings: added {} rows".format(added), file=sys.stderr)
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser(description="Import new CO2 readings into the database")
+    parser.add_argument('dbfile', type=str)
+    parser.add_argument('readingfiles', type=str, nargs='*')
+
+    args = parser.parse_args()
+
+    db = import_offsets.connect(args.dbfile)
+    import_readings(db, args.readingfiles)
+    db.close()
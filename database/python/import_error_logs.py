@@ -0,0 +1,206 @@
+""" Incremental import of unit error logs into the error_logs table
+
+    Replaces bin/import-error-logs.sh, which ran each file through a chain
+    of sed/grep/awk processes and re-imported everything every time.
+
+    Only bytes added to each errors-*.txt file since the last run are read.
+    Files are parsed in parallel by a pool of worker processes, each line
+    once, and the new rows are inserted in a single transaction.
+
+    Each log entry starts with a headline:
+
+        ----- (2019, 7, 28, 10, 0, 10, 6, 209) ERROR message
+
+    Only headlines are imported, with the time tuple as odate and otime.
+    Entries logged before the RTC was set are dated 1970-01-01. For these,
+    idate and itime are inferred from the last real time earlier in the
+    same file (NULL if there is none). etype classifies known messages.
+"""
+
+import multiprocessing
+import os
+import re
+import sys
+
+import import_offsets
+
+TABLE = "error_logs"
+
+# co2unit-<hex> anywhere in the path (the last one, if several)
+unit_id_re = re.compile(r"^.*(co2unit-[0-9a-f]+)")
+
+# Early versions wrote the time tuple alone, and the message on the next line
+bare_headline_re = re.compile(r"^----- \([0-9, ]+\)$")
+
+headline_re = re.compile(
+        r"^----- \(([0-9]+), ([0-9]+), ([0-9]+), ([0-9]+), ([0-9]+), ([0-9]+), [0-9]+, [0-9]+\)"
+        r" ([A-Z]+) *(.*)$")
+
+# Known error types, by message. If several match, the last one listed wins.
+etypes = [
+    ("uncaught", r"Uncaught exception"),
+    ("watchdog", r"[Ww]atch ?dog"),
+    ("signal", r"Signal quality"),
+    ("backoff", r"backoff"),
+    ("transmit", r"transmitting"),
+]
+etype_re = re.compile("|".join("(?P<{}>{})".format(name, pattern) for name, pattern in etypes))
+etype_rank = dict((name, i) for i, (name, _) in enumerate(etypes))
+
+no_rtc_date = "1970-01-01"
+
+def create_tables(db):
+    db.execute("""
+        create table if not exists error_logs (
+            unit_id TEXT,
+            idate   TEXT,   -- inferred date and time
+            itime   TEXT,
+            etype   TEXT,
+            odate   TEXT,   -- original date and time, as logged
+            otime   TEXT,
+            level   TEXT,
+            message TEXT
+        );
+    """)
+    # The last real time seen in each file, for inferring dates
+    # of entries that are appended later
+    db.execute("""
+        create table if not exists error_log_files (
+            path        TEXT primary key,
+            last_date   TEXT,
+            last_time   TEXT
+        );
+    """)
+
+def path_unit_id(path):
+    m = unit_id_re.match(path)
+    return m.group(1) if m else None
+
+def classify(message):
+    etype = None
+    for m in etype_re.finditer(message):
+        if etype is None or etype_rank[m.lastgroup] > etype_rank[etype]:
+            etype = m.lastgroup
+    return etype
+
+def parse_lines(lines, unit_id, last_date, last_time):
+    """ Returns (rows, last_date, last_time, unparsed headline count) """
+    rows = []
+    unparsed = 0
+    fold = None
+    for line in lines:
+        if fold is not None:
+            line = fold + " EXC  " + line
+            fold = None
+        elif bare_headline_re.match(line):
+            fold = line
+            continue
+
+        if not line.startswith("-----"):
+            continue
+        m = headline_re.match(line)
+        if not m:
+            unparsed += 1
+            continue
+
+        y, mo, d, h, mi, s = m.groups()[:6]
+        odate = "{}-{:0>2}-{:0>2}".format(y, mo, d)
+        otime = "{:0>2}:{:0>2}:{:0>2}".format(h, mi, s)
+        level, message = m.group(7), m.group(8)
+
+        if odate != no_rtc_date:
+            last_date, last_time = odate, otime
+        rows.append((unit_id, last_date, last_time, classify(message),
+                odate, otime, level, message))
+
+    if fold is not None:
+        # Bare headline at the very end of a final file, with no message
+        unparsed += 1
+    return rows, last_date, last_time, unparsed
+
+def parse_file(job):
+    """ Parse new lines of one file (run in worker processes)
+
+        Returns (path, rows, new_offset, last_date, last_time, unparsed).
+    """
+    path, offset, final, last_date, last_time = job
+    data, start = import_offsets.read_new_data(path, offset, final)
+
+    # A bare headline's message has not been written yet. Leave it for next time.
+    # Cut at the start of the last line in the raw bytes, so the offset
+    # stays right whatever the line endings or encoding errors.
+    if data and not final:
+        last_start = data.rfind(b"\n", 0, len(data) - 1) + 1
+        last_lines = import_offsets.decode_lines(data[last_start:])
+        if last_lines and bare_headline_re.match(last_lines[-1]):
+            data = data[:last_start]
+
+    lines = import_offsets.decode_lines(data)
+    rows, last_date, last_time, unparsed = parse_lines(lines, path_unit_id(path), last_date, last_time)
+    return path, rows, start + len(data), last_date, last_time, unparsed
+
+def import_error_logs(db, paths, jobs=None):
+    db.execute("begin immediate")
+    try:
+        if not import_offsets.has_offsets(db, TABLE):
+            # Table built by the old drop-and-reload import (or not at all).
+            # Start over once.
+            db.execute("drop table if exists error_logs")
+            db.execute("drop table if exists error_log_files")
+        create_tables(db)
+
+        last_times = dict((path, (last_date, last_time)) for path, last_date, last_time in
+                db.execute("select path, last_date, last_time from error_log_files"))
+
+        # Only files that grew (or shrank)
+        work = []
+        for path, final in import_offsets.final_files(paths):
+            offset = import_offsets.get_offset(db, TABLE, path)
+            if os.path.getsize(path) == offset:
+                continue
+            last_date, last_time = last_times.get(import_offsets.file_key(path), (None, None))
+            if offset > os.path.getsize(path):
+                last_date, last_time = None, None
+            work.append((path, offset, final, last_date, last_time))
+
+        jobs = jobs or min(len(work), os.cpu_count() or 1)
+        if jobs > 1:
+            # Fork, so workers start without re-importing anything
+            ctx = multiprocessing.get_context("fork")
+            with ctx.Pool(jobs) as pool:
+                results = pool.map(parse_file, work)
+        else:
+            results = [parse_file(job) for job in work]
+
+        added = 0
+        unparsed = 0
+        for path, rows, new_offset, last_date, last_time, file_unparsed in results:
+            db.executemany("insert into error_logs values (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            db.execute("insert or replace into error_log_files values (?, ?, ?)",
+                    (import_offsets.file_key(path), last_date, last_time))
+            import_offsets.set_offset(db, TABLE, path, new_offset)
+            added += len(rows)
+            unparsed += file_unparsed
+
+        db.execute("commit")
+    except:
+        db.execute("rollback")
+        raise
+
+    print("## error logs: added {} rows from {} files, skipped {} unparseable headlines"
+            .format(added, len(work), unparsed), file=sys.stderr)
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser(description="Import new error log entries into the database")
+    parser.add_argument('dbfile', type=str)
+    parser.add_argument('logfiles', type=str, nargs='*')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+            help="Number of worker processes (default one per file with new data, up to the CPU count)")
+
+    args = parser.parse_args()
+
+    db = import_offsets.connect(args.dbfile)
+    import_error_logs(db, args.logfiles, args.jobs)
+    db.close()
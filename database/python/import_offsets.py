@@ -0,0 +1,95 @@
+""" Helpers for incremental imports of append-only data files
+
+    The data files (pings, readings, error logs) only ever grow,
+    so each importer records how many bytes of each file it has already
+    ingested and reads only what comes after that on the next run.
+
+    Offsets are stored in the database itself, in the same transaction
+    as the imported rows, so an interrupted import never skips or
+    repeats data.
+"""
+
+import os
+import sqlite3
+import sys
+
+def connect(db_file):
+    # Autocommit mode: transactions are managed explicitly with begin/commit
+    db = sqlite3.connect(db_file, timeout=60, isolation_level=None)
+    db.execute("pragma journal_mode=wal")
+    db.execute("""
+        create table if not exists import_offsets (
+            tbl         TEXT,
+            path        TEXT,
+            offset      INTEGER,
+            primary key (tbl, path)
+        );
+    """)
+    return db
+
+def file_key(path):
+    return os.path.realpath(path)
+
+def has_offsets(db, tbl):
+    row = db.execute("select count(*) from import_offsets where tbl = ?", (tbl,)).fetchone()
+    return row[0] > 0
+
+def clear_offsets(db, tbl):
+    db.execute("delete from import_offsets where tbl = ?", (tbl,))
+
+def get_offset(db, tbl, path):
+    row = db.execute("select offset from import_offsets where tbl = ? and path = ?",
+            (tbl, file_key(path))).fetchone()
+    return row[0] if row else 0
+
+def set_offset(db, tbl, path, offset):
+    db.execute("insert or replace into import_offsets (tbl, path, offset) values (?, ?, ?)",
+            (tbl, file_key(path), offset))
+
+def final_files(paths):
+    """ Yields (path, is_final) with files sorted within each directory
+
+        Every file but the last in its directory is final: it will not grow
+        any more, so a last line without a newline is still a whole record.
+    """
+    by_dir = {}
+    for path in paths:
+        by_dir.setdefault(os.path.dirname(path), []).append(path)
+    for dirname in sorted(by_dir):
+        files = sorted(by_dir[dirname])
+        for i, path in enumerate(files):
+            yield path, i < len(files) - 1
+
+def read_new_data(path, offset, final=False):
+    """ Returns (data, start) for the complete lines after offset
+
+        data is the raw bytes, read from start (normally offset),
+        so the new offset is start + len(data).
+        Partial last lines are left for next time unless the file is final.
+    """
+    with open(path, "rb") as f:
+        size = f.seek(0, os.SEEK_END)
+        if size < offset:
+            print("## {}: file shrank from {} to {} bytes, re-reading from start"
+                    .format(path, offset, size), file=sys.stderr)
+            offset = 0
+        f.seek(offset)
+        data = f.read()
+
+    if not final:
+        data = data[:data.rfind(b"\n")+1]
+    return data, offset
+
+def decode_lines(data):
+    return data.decode("utf-8", errors="replace").splitlines()
+
+def read_new_lines(path, offset, final=False):
+    """ Returns (lines, new_offset) for complete lines after offset
+
+        Partial last lines are left for next time unless the file is final.
+    """
+    data, start = read_new_data(path, offset, final)
+    return decode_lines(data), start + len(data)
+
+def none_to_null(val):
+    return None if val in ("None", "") else val
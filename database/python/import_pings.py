@@ -0,0 +1,235 @@
+""" Incremental import of server ping records into the pings table
+
+    Only bytes added to each pings-*.tsv file since the last run are read,
+    and the new rows are inserted in a single transaction.
+
+    The server also inserts pings live as they arrive. Rows are unique on
+    (unit_id, ping_date, ping_time), so rows that the server already
+    inserted are skipped.
+
+    The unit_ping_days table holds per-unit, per-day ping stats for the
+    summaries. A trigger on pings keeps it current.
+
+    The server's units_last_seen table (see src/server.py), if present,
+    is brought up to date from unit_ping_days after each import.
+"""
+
+import re
+import sys
+
+import change_journal
+import import_offsets
+
+TABLE = "pings"
+
+# 2019-10-07T03:23:39.980794 -> ts 2019-10-07T03:23:39, date 2019-10-07, time 03:23:39.980794
+ts_re = re.compile(r"^(([0-9-]+)T[0-9:]+)")
+
+def create_tables(db):
+    db.execute("""
+        create table if not exists pings (
+            ping_ts     TEXT,
+            ping_date   TEXT,
+            ping_time   TEXT,
+            unit_id     TEXT,
+            nickname    TEXT,
+            rssi_raw    INTEGER,
+            rssi_dbm    INTEGER
+        );
+    """)
+    db.execute("""
+        create unique index if not exists pings_index_by_unit_id
+        on pings (unit_id, ping_date, ping_time);
+    """)
+    change_journal.create_tables(db)
+    create_stats_tables(db)
+
+def create_stats_tables(db):
+    """ Per-unit, per-day ping stats, kept up to date by a trigger
+
+        Summaries and ping plots read this table instead of every ping.
+        The trigger also covers the rows the server inserts live.
+
+        Deployment stats compare ping_date with the deployment start,
+        so one row per day is enough to compute them exactly.
+        first_time and last_time place a day against deployment bounds
+        that fall within the day.
+    """
+    cols = [r[1] for r in db.execute("pragma table_info(unit_ping_days)")]
+    if cols and "first_time" not in cols:
+        # Made before first_time was added. Rebuild it.
+        db.execute("drop table unit_ping_days")
+        db.execute("drop trigger if exists pings_update_unit_ping_days")
+        cols = []
+    if not cols:
+        db.execute("""
+            create table unit_ping_days (
+                unit_id         TEXT,
+                ping_date       TEXT,
+                n               INTEGER,
+                dbm_n           INTEGER,
+                dbm_sum         INTEGER,
+                dbm_min         INTEGER,
+                dbm_max         INTEGER,
+                first_time      TEXT,
+                last_time       TEXT,
+                last_nickname   TEXT,
+                last_dbm        INTEGER,
+                primary key (unit_id, ping_date)
+            );
+        """)
+        # Backfill in one pass over pings
+        db.execute("""
+            insert into unit_ping_days
+            select
+                unit_id, ping_date,
+                count(*), count(rssi_dbm), total(rssi_dbm), min(rssi_dbm), max(rssi_dbm),
+                min(ping_time), max(ping_time), max(last_nickname), max(last_dbm)
+            from (
+                select *,
+                    first_value(nickname) over latest as last_nickname,
+                    first_value(rssi_dbm) over latest as last_dbm
+                from pings
+                where unit_id is not null
+                window latest as (partition by unit_id, ping_date order by ping_time desc)
+            )
+            group by unit_id, ping_date
+        """)
+
+    db.execute("""
+        create trigger if not exists pings_update_unit_ping_days
+        after insert on pings
+        when new.unit_id is not null
+        begin
+            insert or ignore into unit_ping_days (unit_id, ping_date, n, dbm_n, dbm_sum)
+                values (new.unit_id, new.ping_date, 0, 0, 0);
+            update unit_ping_days set
+                n = n + 1,
+                dbm_n = dbm_n + (new.rssi_dbm is not null),
+                dbm_sum = dbm_sum + coalesce(new.rssi_dbm, 0),
+                -- two-argument min/max return NULL if either side is NULL
+                dbm_min = coalesce(min(dbm_min, new.rssi_dbm), dbm_min, new.rssi_dbm),
+                dbm_max = coalesce(max(dbm_max, new.rssi_dbm), dbm_max, new.rssi_dbm),
+                first_time = coalesce(min(first_time, new.ping_time), new.ping_time),
+                last_nickname = case when last_time is null or new.ping_time >= last_time
+                    then new.nickname else last_nickname end,
+                last_dbm = case when last_time is null or new.ping_time >= last_time
+                    then new.rssi_dbm else last_dbm end,
+                last_time = case when last_time is null or new.ping_time >= last_time
+                    then new.ping_time else last_time end
+            where unit_id = new.unit_id and ping_date is new.ping_date;
+        end;
+    """)
+
+    # A new unit-day is what changes the ping plots
+    db.execute("""
+        create trigger if not exists unit_ping_days_journal
+        after insert on unit_ping_days
+        begin
+            insert into change_journal (source, unit_id, min_date, max_date)
+                values ('ping_days', new.unit_id, new.ping_date, new.ping_date);
+        end;
+    """)
+
+def update_units_last_seen(db):
+    """ Upsert each unit's last ping from unit_ping_days into units_last_seen
+
+        The server creates units_last_seen and updates it as pings arrive.
+        This covers pings it never saw live (e.g. older files imported
+        by Make). A newer ping already in the table is never replaced.
+    """
+    exists = db.execute("""
+        select 1 from sqlite_master where type = 'table' and name = 'units_last_seen'
+    """).fetchone()
+    if not exists:
+        return
+    # "where true" keeps "on conflict" from being parsed as part of the select
+    db.execute("""
+        insert into units_last_seen (unit_id, last_ts, nickname, rssi_dbm)
+        select unit_id, max(ping_date) || 'T' || last_time, last_nickname, last_dbm
+        from unit_ping_days
+        where true
+        group by unit_id
+        on conflict (unit_id) do update set
+            last_ts = excluded.last_ts,
+            nickname = excluded.nickname,
+            rssi_raw = null,
+            rssi_dbm = excluded.rssi_dbm
+        where excluded.last_ts > units_last_seen.last_ts
+    """)
+
+def has_unique_index(db):
+    row = db.execute("""
+        select sql from sqlite_master
+        where type = 'index' and name = 'pings_index_by_unit_id'
+    """).fetchone()
+    return row is not None and row[0].lower().startswith("create unique")
+
+def parse_line(line):
+    m = ts_re.match(line)
+    if not m:
+        return None
+    fields = line.split("\t")
+    # Missing fields are NULL, extra fields are ignored
+    fields += [None] * (5 - len(fields))
+    ping_iso, unit_id, nickname, rssi_raw, rssi_dbm = fields[:5]
+    return (
+            m.group(1),
+            m.group(2),
+            ping_iso[len("2019-10-07T"):],
+            unit_id,
+            import_offsets.none_to_null(nickname),
+            import_offsets.none_to_null(rssi_raw),
+            import_offsets.none_to_null(rssi_dbm),
+    )
+
+def import_pings(db, paths):
+    db.execute("begin immediate")
+    try:
+        if not has_unique_index(db):
+            # Table built by the old drop-and-reload import, which could
+            # hold duplicates. Start over once.
+            db.execute("drop table if exists pings")
+            db.execute("drop table if exists unit_ping_days")
+            import_offsets.clear_offsets(db, TABLE)
+        create_tables(db)
+
+        added = 0
+        skipped = 0
+        for path, final in import_offsets.final_files(paths):
+            offset = import_offsets.get_offset(db, TABLE, path)
+            lines, new_offset = import_offsets.read_new_lines(path, offset, final)
+            if new_offset == offset:
+                continue
+
+            rows = []
+            for line in lines:
+                row = parse_line(line)
+                if row: rows.append(row)
+                else:   skipped += 1
+
+            before = db.total_changes
+            db.executemany("insert or ignore into pings values (?, ?, ?, ?, ?, ?, ?)", rows)
+            added += db.total_changes - before
+            import_offsets.set_offset(db, TABLE, path, new_offset)
+
+        update_units_last_seen(db)
+        db.execute("commit")
+    except:
+        db.execute("rollback")
+        raise
+
+    print("## pings: added {} rows, skipped {} unparseable lines".format(added, skipped), file=sys.stderr)
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser(description="Import new pings into the database")
+    parser.add_argument('dbfile', type=str)
+    parser.add_argument('pingfiles', type=str, nargs='*')
+
+    args = parser.parse_args()
+
+    db = import_offsets.connect(args.dbfile)
+    import_pings(db, args.pingfiles)
+    db.close()
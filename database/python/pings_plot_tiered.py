@@ -4,6 +4,8 @@ import pandas as pd
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 
+import deploy_intervals
+
 # Use a colorblind-friendly palette
 plt.style.use('tableau-colorblind10')
 
@@ -108,29 +110,37 @@ def select_deploys(db, xmin, xmax, min_tier):
     deploys['tier'] = deploys['tier'].astype("Int64")
     return deploys
 
-def select_pings(db, deploy_row):
+def select_ping_days(db, deploy_row):
+    """ Days on which the unit pinged during the deployment
+
+        Reads the per-day stats in unit_ping_days (kept up to date by
+        import_pings.py), so this costs one row per day, not one per ping.
+        The nickname column is the nickname of the last ping of the day.
+    """
     sql = """
-        select p.ping_ts, p.nickname
-        from pings p
+        select s.ping_date, s.last_nickname as nickname
+        from unit_ping_days s
         where {where_conds}
-        order by ping_ts
+        order by ping_date
     """
 
-    where_conds = ["p.unit_id = ?"]
+    where_conds = ["s.unit_id = ?"]
     params = [deploy_row.unit_id]
 
     if not pd.isnull(deploy_row.start_ts):
-        where_conds.append("p.ping_ts >= ?")
+        # On the start day, only count pings after the start
+        where_conds.append("s.ping_date || 'T' || s.last_time >= ?")
         params.append(deploy_row.start_ts.isoformat())
 
     if not pd.isnull(deploy_row.end_ts):
-        where_conds.append("p.ping_ts <= ?")
+        # On the end day, only count pings before the end
+        where_conds.append("s.ping_date || 'T' || s.first_time <= ?")
         params.append(deploy_row.end_ts.isoformat())
 
     sql = sql.format(where_conds = " and ".join(where_conds))
-    pings = pd.read_sql(sql, db, params=params,
-            coerce_float=False, parse_dates=['ping_ts'])
-    return pings
+    ping_days = pd.read_sql(sql, db, params=params,
+            coerce_float=False, parse_dates=['ping_date'])
+    return ping_days
 
 def determine_xlim(xmin, xmax, min_tier, deploys):
     deploy_min = deploys.start_ts.dropna().min()
@@ -152,46 +162,6 @@ def determine_xlim(xmin, xmax, min_tier, deploys):
 
     return xmin, xmax
 
-def deploys_overlap(ga, gb):
-
-    for _, a in ga.iterrows():
-        for _, b in gb.iterrows():
-
-            ast = a.start_ts; aen = a.end_ts
-            bst = b.start_ts; ben = b.end_ts
-
-            if ast and aen and bst and ben:     clear = aen <= bst or ben <= ast
-            elif ast and ben:                   clear = ben <= ast
-            elif aen and bst:                   clear = aen <= bst
-            else:                               clear = False
-
-            if not clear: return True
-    return False
-
-def group_deploys(deploys):
-    # First, group by site and unit
-    grouped = deploys.groupby(by=["tier","site","unit_id"], sort=False, dropna=False)
-
-    # Secong, combine (compress) different deployments at the same site,
-    # so long as they don't overlap
-    compressed = []
-    compress = None
-    for (tier, site, unit_id), group in grouped:
-        if compress is None:
-            compress = group
-        elif site == compress.iloc[-1].site and not deploys_overlap(compress, group):
-            compress = pd.concat([compress, group])
-        else:
-            ctuple = ((tier, site), compress)
-            compressed.append(ctuple)
-            compress = group
-    # Add last compress group
-    if compress is not None:
-        compress = ((tier, site), compress)
-        compressed.append(compress)
-
-    return compressed
-
 def format_site_name(group_df):
     sites = group_df.site.unique()
     unit_id = group_df.iloc[-1].unit_id
@@ -223,40 +193,24 @@ def format_nickname(group_df, last_pings_df):
     unit_id = group_df.iloc[-1].nickname
     return unit_id
 
-def draw_pings(ax, yval, pings):
+def draw_pings(ax, yval, ping_days):
     # Pings are drawn by day.
 
     # We are also grouping consecutive days into one bar object,
     # to avoid excessive paths in a vector plot.
-    streaks = []
-    streak_start = None
-    streak_end = None
-    one_day = pd.Timedelta(days=1)
-
-    for ping_ts in pings.ping_ts:
-
-        ping_day = ping_ts.normalize()
-
-        if streak_end and ping_day <= streak_end + one_day:
-            # Continue streak
-            streak_end = ping_day
-
-        else:
-            # Break streak
-            if streak_end:
-                streaks.append((streak_start, streak_end))
-
-            # New streak
-            streak_start = ping_day
-            streak_end = ping_day
+    days = np.unique(ping_days.values.astype("datetime64[D]"))
+    if not len(days):
+        return
 
-    # Add final streak
-    if streak_end:
-        streaks.append((streak_start, streak_end))
+    # A streak breaks wherever the gap to the next day is more than one day
+    breaks = np.flatnonzero(np.diff(days) > np.timedelta64(1, "D"))
+    streak_starts = days[np.concatenate(([0], breaks + 1))]
+    streak_ends = days[np.concatenate((breaks, [len(days) - 1]))]
 
     # Convert start/end streaks to start/length bars
-    bars = [(streak_start, streak_end-streak_start+one_day) \
-            for (streak_start,streak_end) in streaks]
+    one_day = np.timedelta64(1, "D")
+    bars = list(zip(pd.to_datetime(streak_starts),
+            pd.to_timedelta(streak_ends - streak_starts + one_day)))
 
     ping_bar_height = .6
     ylow = yval - ping_bar_height / 2.0
@@ -290,7 +244,7 @@ def draw_deploy_markers(ax, yval, deploy, xmin, xmax):
 
 def build_plot(db, xmin=None, xmax=None, min_tier=None):
     deploys = select_deploys(db, xmin, xmax, min_tier)
-    grouped = group_deploys(deploys)
+    grouped = deploy_intervals.group_deploys(deploys)
     num_groups = len(grouped)
 
     # Initialize figure
@@ -317,14 +271,12 @@ def build_plot(db, xmin=None, xmax=None, min_tier=None):
         # Each deployment in row
 
         for j, deploy_row in group.iterrows():
-            pings = select_pings(db, deploy_row)
-            draw_pings(ax, yval, pings)
-            if len(pings):
-                last_nick = pings.iloc[-1].nickname
+            ping_days = select_ping_days(db, deploy_row)
+            draw_pings(ax, yval, ping_days.ping_date)
             draw_deploy_markers(ax, yval, deploy_row, xmin, xmax)
 
         ylabels_left.append(format_site_name(group))
-        ylabels_right.append(format_nickname(group, pings))
+        ylabels_right.append(format_nickname(group, ping_days))
 
     # Format x axis
     major_locator = mpl.dates.AutoDateLocator()
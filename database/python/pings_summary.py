@@ -7,41 +7,66 @@ def fetch_pings_by_unit_id(db):
     """ Elaborate pings-by-unit-id query
 
         Takes a database connection, returns a pandas Dataframe with results.
+
+        Reads the per-unit, per-day stats in unit_ping_days (maintained by
+        import_pings.py) rather than scanning the whole pings table.
     """
 
     sql = """
+        with
+        -- Latest day per unit. With max(), SQLite takes the bare columns
+        -- from the row holding the max ping_date.
+        last_day as (
+                select unit_id, max(ping_date) as ping_date, last_nickname, last_dbm
+                from unit_ping_days
+                group by unit_id
+        ),
+        -- Pings since the start of each open deployment
+        deploy_days as (
+                select
+                        s.unit_id,
+                        d.start_ts,
+                        max(s.ping_date) as ping_date,
+                        count(*) as n_days,
+                        max(s.dbm_max) as dbm_max,
+                        1.0 * sum(s.dbm_sum) / sum(s.dbm_n) as dbm_mean,
+                        min(s.dbm_min) as dbm_min
+                from deploy_durations_tiered as d
+                join unit_ping_days as s
+                        on s.unit_id = d.unit_id
+                        and s.ping_date > d.start_ts
+                where d.end_ts is null
+                group by s.unit_id, d.start_ts
+        )
         select
                 u.unit_id,
-                lp.nickname,
+                u.last_nickname as nickname,
                 d.site,
                 -- d.action,
                 -- d.start_ts,
-                lp.ping_date as last_ping,
-                lp.rssi_dbm as last_dbm,
-                dp.ping_date as last_deploy_ping,
-                dp.rssi_dbm as last_deploy_dbm,
+                u.ping_date as last_ping,
+                u.last_dbm as last_dbm,
+                case when d.site is not null then dp.ping_date end as last_deploy_ping,
+                case when d.site is not null then dl.last_dbm end as last_deploy_dbm,
                 case
                         when d.start_ts is not null
-                                then (select count(distinct ping_date) from pings where pings.unit_id = d.unit_id and ping_date > d.start_ts)
+                                then coalesce(dp.n_days, 0)
                         else null
                 end	as deploy_ping_days,
                 cast (( julianday() - julianday(d.start_ts) ) as integer) as deploy_days,
-                (select max(rssi_dbm)             from pings where pings.unit_id = d.unit_id and ping_date > d.start_ts) as deploy_dbm_max,
-                (select avg(rssi_dbm)             from pings where pings.unit_id = d.unit_id and ping_date > d.start_ts) as deploy_dbm_mean,
-                (select min(rssi_dbm)             from pings where pings.unit_id = d.unit_id and ping_date > d.start_ts) as deploy_dbm_min
-        from (select distinct unit_id from pings) as u
-        left join pings as lp
-                on lp.unit_id = u.unit_id
-                and lp.ping_date = (select ping_date from pings where pings.unit_id = u.unit_id order by ping_date desc, ping_time desc limit 1)
-                and lp.ping_time = (select ping_time from pings where pings.unit_id = u.unit_id order by ping_date desc, ping_time desc limit 1)
+                dp.dbm_max as deploy_dbm_max,
+                dp.dbm_mean as deploy_dbm_mean,
+                dp.dbm_min as deploy_dbm_min
+        from last_day as u
         left join deploy_durations_tiered as d
                 on d.unit_id = u.unit_id
                 and d.end_ts is null
-        left join pings as dp
+        left join deploy_days as dp
                 on dp.unit_id = u.unit_id
-                and dp.ping_date = (select ping_date from pings where pings.unit_id = u.unit_id and ping_date > d.start_ts order by ping_date desc, ping_time desc limit 1)
-                and dp.ping_time = (select ping_time from pings where pings.unit_id = u.unit_id and ping_date > d.start_ts order by ping_date desc, ping_time desc limit 1)
-                and d.site is not null
+                and dp.start_ts = d.start_ts
+        left join unit_ping_days as dl
+                on dl.unit_id = dp.unit_id
+                and dl.ping_date = dp.ping_date
         order by
                 case
                         -- group by deployment site
@@ -52,7 +77,7 @@ def fetch_pings_by_unit_id(db):
                 deploy_ping_days desc,
                 d.site desc,
                 last_ping desc,
-                lp.nickname
+                nickname
         """
 
     cur = db.execute(sql)
@@ -60,14 +85,13 @@ def fetch_pings_by_unit_id(db):
 
     col_names = [column[0] for column in cur.description]
     df = pd.DataFrame.from_records(data=rows, columns=col_names)
-    db.close()
 
     # Massage data
     def intfmt(n):
         try:
             return str(int(n))
-        except ValueError:
-            # If n is non-integer (corrupt or NaN)
+        except (ValueError, TypeError):
+            # If n is non-integer (corrupt, NaN, or None)
             return ""
 
     df.deploy_days = df.deploy_days.apply(intfmt)
@@ -76,16 +100,7 @@ def fetch_pings_by_unit_id(db):
 
     return df
 
-if __name__ == "__main__":
-
-    import argparse
-    parser = argparse.ArgumentParser(description="Generate pings summary")
-    parser.add_argument('dbfile', type=str)
-    parser.add_argument('templatefile', type=str)
-
-    args = parser.parse_args()
-
-    db = sqlite3.connect(args.dbfile)
+def render_html(db, templatefile):
     pings_by_unit_id = fetch_pings_by_unit_id(db)
 
     table_html = pings_by_unit_id.to_html(
@@ -95,7 +110,20 @@ if __name__ == "__main__":
                 float_format = lambda n: "{:.1f}".format(n) if n==n else "",
                 )
 
-    with open(args.templatefile) as f:
+    with open(templatefile) as f:
         template = jinja2.Template(f.read())
 
-    print(template.render(table=table_html))
+    return template.render(table=table_html)
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser(description="Generate pings summary")
+    parser.add_argument('dbfile', type=str)
+    parser.add_argument('templatefile', type=str)
+
+    args = parser.parse_args()
+
+    db = sqlite3.connect(args.dbfile)
+    print(render_html(db, args.templatefile))
+    db.close()
@@ -0,0 +1,242 @@
+""" Render all of the web plots and pages in one command
+
+    Each plot script used to run as its own Python process, importing
+    pandas and matplotlib and opening the database every time.
+    Here the plotting modules are imported once, and the artifacts are
+    rendered in parallel by worker processes forked from this one,
+    each with its own database connection.
+
+    Only artifacts whose inputs changed since they were last rendered
+    are rendered again (see change_journal.py). When nothing changed,
+    pandas and matplotlib are not even imported.
+"""
+
+import datetime
+import hashlib
+import importlib
+import multiprocessing
+import os
+import sqlite3
+import sys
+import time
+
+import change_journal
+
+def render_pings_summary(db, outfile, templates_dir):
+    import pings_summary
+    html = pings_summary.render_html(db, os.path.join(templates_dir, "pings_summary.html"))
+    with open(outfile, "w") as f:
+        f.write(html)
+
+def render_pings_plot(db, outfile, templates_dir, **kwargs):
+    import pings_plot_tiered
+    fig = pings_plot_tiered.build_plot(db, **kwargs)
+    save_figure(fig, outfile)
+
+def render_co2_plot(db, outfile, templates_dir, **kwargs):
+    import co2_plot_tiered
+    fig = co2_plot_tiered.build_plot(db, export_dir=_worker.get("export_dir"), **kwargs)
+    save_figure(fig, outfile)
+
+def save_figure(fig, outfile):
+    import matplotlib.pyplot as plt
+    fmt = os.path.splitext(outfile)[1][1:]
+    with open(outfile, "wb") as f:
+        fig.savefig(f, format=fmt)
+    # Workers render several plots, so free each one when done
+    plt.close(fig)
+
+# Imported before forking the workers, if anything needs rendering
+plot_modules = ["pings_summary", "pings_plot_tiered", "co2_plot_tiered"]
+
+# Output filename -> (render function, extra arguments, data source)
+#
+# Data sources are change journal sources, except for "pings":
+# the pings summary shows stats that change with every ping,
+# so it is checked against the last row in the pings table instead.
+artifacts = {
+        "pings_summary.html":           (render_pings_summary, {}, "pings"),
+        "pings_all_tiered.svg":         (render_pings_plot, {}, "ping_days"),
+        "co2_tiered_all_hires.svg":     (render_co2_plot, {}, "co2_readings"),
+        "co2_tiered_recent_hires.svg":  (render_co2_plot, {"recent_days": 14}, "co2_readings"),
+}
+
+# Change tracking
+#
+# Each artifact's last render is kept in the render_state table:
+# the change journal seq it had seen, and a fingerprint of the inputs
+# that are not in the journal (today's date, which sets the plot ranges,
+# and the deployments table, which is reloaded wholesale).
+
+def create_state_table(db):
+    db.execute("""
+        create table if not exists render_state (
+            artifact    TEXT primary key,
+            seq         INTEGER,
+            fingerprint TEXT
+        );
+    """)
+
+def fingerprint(db, source):
+    h = hashlib.sha1()
+    h.update(datetime.date.today().isoformat().encode())
+    try:
+        for row in db.execute("select * from deploy_durations_tiered order by 1, 2, 3, 4, 5, 6, 7"):
+            h.update(repr(row).encode())
+    except sqlite3.OperationalError:
+        pass
+    if source == "pings":
+        try:
+            h.update(repr(db.execute("select max(rowid) from pings").fetchone()).encode())
+        except sqlite3.OperationalError:
+            pass
+    return h.hexdigest()
+
+def dirty_artifacts(db, outdir, names, force=False):
+    """ Returns {name: reason} for artifacts that need rendering """
+    journal = change_journal.has_journal(db)
+    state = dict((a, (seq, fp)) for a, seq, fp in
+            db.execute("select artifact, seq, fingerprint from render_state"))
+
+    dirty = {}
+    for name in names:
+        fn, kwargs, source = artifacts[name]
+        if force:
+            dirty[name] = "forced"
+        elif name not in state:
+            dirty[name] = "no previous render"
+        elif not os.path.exists(os.path.join(outdir, name)):
+            dirty[name] = "missing"
+        elif state[name][1] != fingerprint(db, source):
+            dirty[name] = "date or deployments changed" if source != "pings" \
+                    else "date, deployments, or pings changed"
+        elif source != "pings":
+            if not journal:
+                dirty[name] = "no change journal"
+                continue
+            min_date = None
+            if kwargs.get("recent_days"):
+                min_date = (datetime.date.today()
+                        - datetime.timedelta(days=kwargs["recent_days"])).isoformat()
+            changed = change_journal.changes_since(db, source, state[name][0], min_date)
+            if changed:
+                dirty[name] = "{} changed for {} units".format(source, len(changed))
+    return dirty
+
+# Worker processes
+
+_worker = {}
+
+def init_worker(dbfile, outdir, templates_dir, export_dir=None):
+    _worker["db"] = sqlite3.connect(dbfile)
+    _worker["outdir"] = outdir
+    _worker["templates_dir"] = templates_dir
+    _worker["export_dir"] = export_dir
+
+def render_one(name):
+    """ Render one artifact. Returns (name, seconds, error or None). """
+    fn, kwargs, source = artifacts[name]
+    outfile = os.path.join(_worker["outdir"], name)
+    # Render to a temporary file, so a failed render leaves the old one
+    tmpfile = os.path.join(_worker["outdir"], ".tmp-" + name)
+    t0 = time.monotonic()
+    try:
+        fn(_worker["db"], tmpfile, _worker["templates_dir"], **kwargs)
+        os.replace(tmpfile, outfile)
+        error = None
+    except Exception as e:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        error = "{}: {}".format(type(e).__name__, e)
+    return name, time.monotonic() - t0, error
+
+def render_all(dbfile, outdir, names, templates_dir="templates_web", jobs=None, force=False,
+        export_dir=None):
+    """ Render the named artifacts into outdir if their inputs changed
+
+        Returns the number that failed.
+    """
+    os.makedirs(outdir, exist_ok=True)
+
+    # Autocommit mode: transactions are managed explicitly with begin/commit
+    db = sqlite3.connect(dbfile, isolation_level=None)
+    create_state_table(db)
+
+    # Snapshot the state to save before rendering,
+    # so changes that land during the render are picked up next time
+    db.execute("begin")
+    dirty = dirty_artifacts(db, outdir, names, force)
+    seq = change_journal.current_seq(db) if change_journal.has_journal(db) else 0
+    fingerprints = dict((name, fingerprint(db, artifacts[name][2])) for name in dirty)
+    db.execute("commit")
+
+    for name in names:
+        if name not in dirty:
+            print("## {}: unchanged".format(name), file=sys.stderr)
+
+    failed = 0
+    rendered = []
+    if dirty:
+        for module in plot_modules:
+            importlib.import_module(module)
+
+        jobs = jobs or min(len(dirty), os.cpu_count() or 1)
+
+        # Fork, so workers inherit the modules already imported here
+        ctx = multiprocessing.get_context("fork")
+        with ctx.Pool(jobs, initializer=init_worker,
+                initargs=(dbfile, outdir, templates_dir, export_dir)) as pool:
+            for name, seconds, error in pool.imap_unordered(render_one, list(dirty)):
+                if error:
+                    failed += 1
+                    print("## {}: FAILED after {:.1f} s: {}".format(name, seconds, error), file=sys.stderr)
+                else:
+                    rendered.append(name)
+                    print("## {}: rendered in {:.1f} s ({})".format(name, seconds, dirty[name]), file=sys.stderr)
+
+    db.execute("begin")
+    for name in rendered:
+        db.execute("insert or replace into render_state values (?, ?, ?)",
+                (name, seq, fingerprints[name]))
+    # Unchanged artifacts have also seen the journal up to seq
+    for name in names:
+        if name not in dirty:
+            db.execute("update render_state set seq = ? where artifact = ?", (seq, name))
+    # Journal entries seen by every artifact are no longer needed
+    if change_journal.has_journal(db):
+        row = db.execute("select count(*), min(seq) from render_state where artifact in ({})"
+                .format(", ".join("?" * len(artifacts))), list(artifacts)).fetchone()
+        if row[0] == len(artifacts):
+            change_journal.prune(db, row[1])
+    db.execute("commit")
+    db.close()
+
+    return failed
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser(description="Render web plots and pages")
+    parser.add_argument('dbfile', type=str)
+    parser.add_argument('outdir', type=str)
+    parser.add_argument('names', type=str, nargs='*',
+            help="Artifacts to render (default all): {}".format(", ".join(artifacts)))
+    parser.add_argument('--templates', type=str, default="templates_web",
+            help="Directory of HTML templates")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+            help="Number of worker processes (default one per artifact, up to the CPU count)")
+    parser.add_argument('--force', action='store_true',
+            help="Render even if the inputs have not changed (e.g. after code changes)")
+    parser.add_argument('--export-dir', type=str, default=None,
+            help="Plot raw readings from Arrow files written by export_arrow.py")
+
+    args = parser.parse_args()
+
+    names = args.names or list(artifacts)
+    unknown = [n for n in names if n not in artifacts]
+    if unknown:
+        parser.error("unknown artifacts: {}".format(", ".join(unknown)))
+
+    failed = render_all(args.dbfile, args.outdir, names, args.templates, args.jobs, args.force,
+            args.export_dir)
+    sys.exit(1 if failed else 0)
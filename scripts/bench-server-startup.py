@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+""" Measure how long a fresh server process takes to start, and its memory
+
+    Each run starts a new Python process in src/ that imports the server
+    module and answers one request, as a uWSGI worker would on (re)spawn.
+    Reports the import time, the time to the first response, and the
+    resident memory (RSS) after it.
+
+    To compare with the old start-up, --preload imports modules before
+    the server, e.g. the pandas, numpy and json2table the server used to load:
+
+        ./scripts/bench-server-startup.py
+        ./scripts/bench-server-startup.py --preload pandas numpy json2table
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+src_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+# Runs in the child process. Prints one JSON line of measurements.
+child_code = """
+import json, sys, time
+t0 = time.perf_counter()
+for name in sys.argv[1:]:
+    __import__(name)
+import server
+t1 = time.perf_counter()
+with server.app.test_client() as client:
+    client.get("/")
+t2 = time.perf_counter()
+
+rss_kb = None
+with open("/proc/self/status") as f:
+    for line in f:
+        if line.startswith("VmRSS:"):
+            rss_kb = int(line.split()[1])
+print(json.dumps({
+    "import_s": t1 - t0,
+    "first_response_s": t2 - t0,
+    "rss_mb": rss_kb / 1024,
+    "modules": len(sys.modules),
+}))
+"""
+
+def run_once(python, preload):
+    out = subprocess.run([python, "-c", child_code] + preload,
+            cwd=src_dir, stdout=subprocess.PIPE, check=True)
+    return json.loads(out.stdout.decode().strip().splitlines()[-1])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark server worker start-up time and memory")
+    parser.add_argument("-n", "--runs", type=int, default=10,
+            help="Number of fresh processes to start (default 10)")
+    parser.add_argument("--python", type=str, default=sys.executable,
+            help="Python interpreter to run the server with (default this one)")
+    parser.add_argument("--preload", type=str, nargs="*", default=[],
+            help="Modules to import before the server")
+    args = parser.parse_args()
+
+    # One untimed run, so every timed run finds the files in the OS cache
+    run_once(args.python, args.preload)
+    results = [run_once(args.python, args.preload) for _ in range(args.runs)]
+
+    print("preload: {}".format(" ".join(args.preload) or "(none)"))
+    print("runs: {}".format(args.runs))
+    for key, label, scale, unit in [
+            ("import_s", "import", 1000, "ms"),
+            ("first_response_s", "first response", 1000, "ms"),
+            ("rss_mb", "RSS", 1, "MB"),
+            ("modules", "modules loaded", 1, ""),
+        ]:
+        values = [r[key] * scale for r in results]
+        print("{:>16}: median {:8.1f} {:2}  (min {:.1f}, max {:.1f})".format(
+            label, statistics.median(values), unit, min(values), max(values)))
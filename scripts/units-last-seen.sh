@@ -1,13 +1,29 @@
 #!/bin/bash
 
-pingsfile=$(find var/pings/* | sort -r | head -n2)
-hwids=$(cut -f2 $pingsfile | sort | uniq)
-# For each unique hardware id in the pings file
-for hwid in $hwids; do
-	# tac --- Search backwards through the pings file for the last ping,
-	# awk --- Re-order the output fields (site code, time, hardware id)
-	# sed --- Reformat the ISO date to be more readable
-	tac $pingsfile | grep $hwid | head -n1 \
-		| awk 'BEGIN {OFS="\t"}; {print $3, $1, $2}' \
-		| sed -E 's/([0-9-]{10})T([0-9:]{8}).[0-9]+/\1 \2/'
-done | sort $@
+# Last ping of each unit: site code, time, hardware id
+#
+# The server keeps this up to date as pings arrive,
+# so this no longer has to search through the pings files.
+#
+# If the server cannot be reached, reads the database directly instead
+# (e.g. offline, or on a copy of the database). Its unit_ping_days table
+# is kept current by both the server and the Make import.
+
+SERVER_URL="${SERVER_URL:-http://localhost:8080}"
+DB_FILE="${DB_FILE:-var/db.sqlite3}"
+
+if ! lastseen=$(curl -sf "$SERVER_URL/status/alive/last-seen.tsv"); then
+	echo "## $SERVER_URL not reachable, reading $DB_FILE" >&2
+	# Same columns and formats as the server's last-seen.tsv
+	lastseen=$(sqlite3 -separator $'\t' "$DB_FILE" "
+		select coalesce(last_nickname, 'None'),
+			max(ping_date) || ' ' || substr(last_time, 1, 8),
+			unit_id
+		from unit_ping_days
+		group by unit_id;
+	") || exit 1
+fi
+
+if [ -n "$lastseen" ]; then
+	printf '%s\n' "$lastseen" | sort $@
+fi
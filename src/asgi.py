@@ -0,0 +1,215 @@
+""" Async (ASGI) front end for the server
+
+    Under uWSGI, a unit pushing data over a slow LTE CAT-M1 link holds a
+    whole worker process until the last byte of the body arrives, so the
+    number of units that can upload at once is the number of workers.
+
+    Here request bodies are read on an asyncio event loop, where a slow
+    link costs a coroutine instead of a worker. Once a body is complete,
+    the request is handed to the same Flask app (server.py) in a bounded
+    thread pool, which does the file and SQLite work. Routes and responses
+    are the server's own. Responses are collected in the thread too, and
+    sent from the event loop, so slow downloads do not hold threads either.
+
+    Bodies and responses are kept in memory up to PUSH_BUFFER_SIZE bytes,
+    and spooled to temporary files beyond that. Bodies larger than
+    ASGI_MAX_BODY_SIZE are refused with a 413, before any of them is
+    spooled, so one client cannot fill the disk.
+
+    Run with any ASGI server, e.g. from the src/ directory:
+
+        uvicorn asgi:app --host 0.0.0.0 --port 8080
+"""
+
+import asyncio
+import concurrent.futures
+import io
+import os
+import sys
+import tempfile
+
+import werkzeug.exceptions
+
+import server
+
+# Thread pool
+#=================================================================
+#
+# Created lazily and keyed on the process id, like the db writer,
+# in case the ASGI server forks workers after importing this module.
+
+_executor = None
+_executor_pid = None
+
+def executor():
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=server.app.config["ASGI_THREADS"],
+                thread_name_prefix="asgi")
+        _executor_pid = os.getpid()
+    return _executor
+
+async def in_thread(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(executor(), fn, *args)
+
+def spool():
+    return tempfile.SpooledTemporaryFile(max_size=server.app.config["PUSH_BUFFER_SIZE"])
+
+# WSGI bridge
+#=================================================================
+# PEP 3333 (WSGI):  https://www.python.org/dev/peps/pep-3333/
+# ASGI HTTP spec:   https://asgi.readthedocs.io/en/latest/specs/www.html
+
+def wsgi_environ(scope, body, length):
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    client = scope.get("client")
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        # WSGI strings are bytes decoded as latin-1
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+        "REMOTE_ADDR": client[0] if client else "",
+        "CONTENT_LENGTH": str(length),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_LENGTH":
+            continue
+        key = "CONTENT_TYPE" if name == "CONTENT_TYPE" else "HTTP_" + name
+        environ[key] = environ[key] + "," + value if key in environ else value
+    return environ
+
+def run_wsgi(environ, wsgi_app=None):
+    """ Run the Flask app (or wsgi_app) on one request (in a pool thread)
+
+        Returns (status code, headers, spooled body, body length).
+        The whole response is produced here, in one thread,
+        since some responses iterate over a thread's SQLite cursor.
+    """
+    started = []
+    def start_response(status, headers, exc_info=None):
+        started[:] = [int(status.split(" ", 1)[0]), headers]
+
+    out = spool()
+    length = 0
+    result = (wsgi_app or server.app)(environ, start_response)
+    try:
+        for chunk in result:
+            out.write(chunk)
+            length += len(chunk)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    out.seek(0)
+    status, headers = started
+    return status, headers, out, length
+
+# ASGI app
+#=================================================================
+
+def declared_length(scope):
+    """ The request's Content-Length, or None """
+    for name, value in scope["headers"]:
+        if name.lower() == b"content-length":
+            try:
+                return int(value)
+            except ValueError:
+                return None
+    return None
+
+async def read_body(receive, max_size):
+    """ Returns (spooled body, length)
+
+        If the client went away, returns (None, 0). If the body is larger
+        than max_size, stops reading and returns (None, length so far).
+    """
+    body = spool()
+    length = 0
+    limit = server.app.config["PUSH_BUFFER_SIZE"]
+    more = True
+    while more:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            body.close()
+            return None, 0
+        chunk = message.get("body", b"")
+        more = message.get("more_body", False)
+        if length + len(chunk) > max_size:
+            body.close()
+            return None, length + len(chunk)
+        if length + len(chunk) > limit:
+            # Past the in-memory limit, so this write goes to disk
+            await in_thread(body.write, chunk)
+        else:
+            body.write(chunk)
+        length += len(chunk)
+    body.seek(0)
+    return body, length
+
+async def send_response(send, status, headers, out, length):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers],
+    })
+    limit = server.app.config["PUSH_BUFFER_SIZE"]
+    on_disk = length > limit
+    while True:
+        chunk = await in_thread(out.read, limit) if on_disk else out.read(limit)
+        if not chunk:
+            break
+        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+    await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if _executor is not None and _executor_pid == os.getpid():
+                _executor.shutdown(wait=True)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        raise ValueError("Unsupported ASGI scope type: {}".format(scope["type"]))
+
+    max_size = server.app.config["ASGI_MAX_BODY_SIZE"]
+    declared = declared_length(scope)
+    if declared is not None and declared > max_size:
+        body, length = None, declared
+    else:
+        body, length = await read_body(receive, max_size)
+
+    if body is not None:
+        try:
+            status, headers, out, out_length = await in_thread(run_wsgi,
+                    wsgi_environ(scope, body, length))
+        finally:
+            body.close()
+    elif length > max_size:
+        status, headers, out, out_length = run_wsgi(wsgi_environ(scope, io.BytesIO(), 0),
+                werkzeug.exceptions.RequestEntityTooLarge())
+    else:
+        return
+    try:
+        await send_response(send, status, headers, out, out_length)
+    finally:
+        out.close()
@@ -0,0 +1,143 @@
+import datetime
+import json
+import math
+import re
+
+# Time-bucketed CO2 queries
+#=================================================================
+#
+# Reads the co2_samples table and its rollups, as built by
+# ../database/python/import_co2_readings.py.
+#
+# Buckets are aligned to the Unix epoch (so days are UTC days).
+# Buckets that are whole days or hours are combined from the daily or
+# hourly rollup tables. Other bucket sizes are aggregated from the raw
+# readings in co2_samples, by a seek on its (unit_key, ts) primary key.
+
+columns = ["ts", "n", "co2_mean", "co2_min", "co2_max", "temp_mean"]
+
+bucket_units = {
+        "s": 1,
+        "min": 60,
+        "h": 60 * 60,
+        "d": 24 * 60 * 60,
+}
+
+# Rollup table -> bucket seconds, coarsest first
+rollup_tables = [
+        ("co2_rollup_daily", 24 * 60 * 60),
+        ("co2_rollup_hourly", 60 * 60),
+]
+
+# Temperature readings of exactly this value mean the sensor maxed out
+temp_maxout_value = 85.0
+
+co2_cols = ["co2_{:02d}".format(i) for i in range(1,11)]
+
+def parse_bucket(text):
+    """ "15min", "1h", "2d", ... -> seconds """
+    m = re.fullmatch(r"([0-9]+)\s*([a-z]+)", text.strip())
+    if not m or m.group(2) not in bucket_units:
+        raise ValueError("bucket must be a number and one of: {}".format(", ".join(bucket_units)))
+    secs = int(m.group(1)) * bucket_units[m.group(2)]
+    if secs <= 0:
+        raise ValueError("bucket must be positive")
+    return secs
+
+def parse_time(text):
+    """ ISO date or datetime -> naive UTC datetime """
+    ts = datetime.datetime.fromisoformat(text.strip())
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return ts
+
+epoch_start = datetime.datetime(1970, 1, 1)
+
+def align(ts, secs, up=False):
+    """ Round ts down (or up) to a bucket boundary """
+    n = (ts - epoch_start).total_seconds() / secs
+    n = math.ceil(n) if up else math.floor(n)
+    return epoch_start + datetime.timedelta(seconds=n * secs)
+
+def to_epoch(ts):
+    return int((ts - epoch_start).total_seconds())
+
+def table_exists(db, table):
+    row = db.execute("select 1 from sqlite_master where type = 'table' and name = ?", (table,)).fetchone()
+    return row is not None
+
+def choose_rollup_table(db, bucket_secs):
+    for table, secs in rollup_tables:
+        if bucket_secs % secs == 0 and table_exists(db, table):
+            return table
+    return None
+
+def select_buckets(db, unit_id, start, end, bucket_secs):
+    """ Cursor over one row per bucket (see columns) overlapping [start, end) """
+    start = align(start, bucket_secs)
+    end = align(end, bucket_secs, up=True)
+
+    epoch = "cast(strftime('%s', {}) as integer)"
+    bucket = "({} / {secs}) * {secs}"
+
+    table = choose_rollup_table(db, bucket_secs)
+    if table:
+        sql = """
+            select
+                strftime('%Y-%m-%dT%H:%M:%S', b, 'unixepoch') as ts,
+                sum(n),
+                sum(n * co2_mean) / nullif(sum(n), 0),
+                min(co2_min),
+                max(co2_max),
+                sum(temp_n * temp_mean) / nullif(sum(temp_n), 0)
+            from (
+                select {bucket} as b, *
+                from {table}
+                where unit_id = ? and bucket_ts >= ? and bucket_ts < ?
+            )
+            group by b
+            order by b
+        """.format(table=table,
+                bucket=bucket.format(epoch.format("bucket_ts"), secs=bucket_secs))
+        params = (unit_id, start.isoformat(), end.isoformat())
+
+    else:
+        row_n = " + ".join("({} is not null)".format(c) for c in co2_cols)
+        row_sum = " + ".join("coalesce({}, 0)".format(c) for c in co2_cols)
+        sql = """
+            select
+                strftime('%Y-%m-%dT%H:%M:%S', b, 'unixepoch') as ts,
+                count(co2), avg(co2), min(co2), max(co2), avg(temp)
+            from (
+                select
+                    {bucket} as b,
+                    ({row_sum}) * 1.0 / nullif({row_n}, 0) as co2,
+                    case when temp != ? then temp end as temp
+                from co2_samples
+                where unit_key = (select unit_key from units where unit_id = ?)
+                    and ts >= ? and ts < ?
+            )
+            group by b
+            order by b
+        """.format(row_sum=row_sum, row_n=row_n,
+                bucket=bucket.format("ts", secs=bucket_secs))
+        params = (temp_maxout_value, unit_id, to_epoch(start), to_epoch(end))
+
+    return db.execute(sql, params)
+
+def round_row(row, ndigits=2):
+    return [round(v, ndigits) if isinstance(v, float) else v for v in row]
+
+def jsonl_lines(rows):
+    for row in rows:
+        yield json.dumps(dict(zip(columns, round_row(row)))) + "\n"
+
+def csv_lines(rows):
+    yield ",".join(columns) + "\n"
+    for row in rows:
+        yield ",".join("" if v is None else str(v) for v in round_row(row)) + "\n"
+
+formats = {
+        "jsonl": (jsonl_lines, "application/x-ndjson"),
+        "csv": (csv_lines, "text/csv"),
+}
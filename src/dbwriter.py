@@ -0,0 +1,215 @@
+import atexit
+import logging
+import os
+import pathlib
+import queue
+import sqlite3
+import threading
+import time
+
+_logger = logging.getLogger("dbwriter")
+#_logger.setLevel(logging.DEBUG)
+
+# Connections
+#=================================================================
+#
+# uWSGI forks its workers after the app module is imported,
+# so everything here is created lazily and keyed on the process id.
+# A connection or thread inherited from the master is never reused.
+
+def connect(db_path, timeout=30):
+    # Autocommit mode: the writer manages its own transactions
+    db = sqlite3.connect(db_path, timeout=timeout, isolation_level=None)
+    # WAL lets readers (Make, plot scripts, status pages) carry on while
+    # the server writes, and makes each commit a sequential append
+    db.execute("pragma journal_mode=wal")
+    # In WAL mode, normal sync only fsyncs at checkpoints.
+    # Pings and readings are also kept in flat files, so that is safe enough.
+    db.execute("pragma synchronous=normal")
+    return db
+
+_local = threading.local()
+
+def connection(db_path):
+    """ Per-thread, per-process pooled connection for reads """
+    pool = getattr(_local, "pool", None)
+    if pool is None or _local.pid != os.getpid():
+        pool = _local.pool = {}
+        _local.pid = os.getpid()
+    if db_path not in pool:
+        pool[db_path] = connect(db_path)
+    return pool[db_path]
+
+# Batched writer
+#=================================================================
+
+class BatchWriter:
+    """ Background group-commit queue for one database
+
+        Requests submit statements and return right away.
+        A writer thread commits them in batches, flushing when the batch
+        reaches batch_size or when flush_interval seconds have passed
+        since the first statement in the batch was queued.
+
+        Each statement may name a mark file to touch once it is committed,
+        so Make knows the database has new data.
+    """
+
+    def __init__(self, db_path, batch_size=200, flush_interval=1.0,
+            max_queue=10000):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self._stats = {
+                "submitted": 0,
+                "dropped": 0,
+                "batches": 0,
+                "statements": 0,
+                "errors": 0,
+                "last_batch_size": 0,
+                "last_flush_ms": None,
+                "max_flush_ms": None,
+                "total_flush_ms": 0.0,
+        }
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.max_queue)
+            self._reset_stats()
+            self._thread = threading.Thread(target=self._run,
+                    name="dbwriter", daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+            atexit.register(self.close)
+            _logger.info("%s : started writer thread in pid %d", self.db_path, self._pid)
+
+    def submit(self, sql, params=(), mark=None):
+        self.submit_call(lambda db: db.execute(sql, params), mark)
+
+    def submit_call(self, fn, mark=None):
+        """ Queue fn(db) to run inside the next batch transaction """
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((fn, mark))
+            self._stats["submitted"] += 1
+        except queue.Full:
+            self._stats["dropped"] += 1
+            _logger.warning("%s : write queue full, dropping statement", self.db_path)
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats["queue_depth"] = self._queue.qsize() if self._queue else 0
+        total_ms = stats.pop("total_flush_ms")
+        stats["mean_flush_ms"] = total_ms / stats["batches"] if stats["batches"] else None
+        return stats
+
+    def close(self, timeout=5.0):
+        if self._pid != os.getpid():
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+    def _run(self):
+        db = None
+        done = False
+        while not done:
+            job = self._queue.get()
+            if job is None:
+                break
+
+            # Gather a batch: up to batch_size jobs, waiting at most
+            # flush_interval after the first one arrived
+            batch = [job]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    job = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if job is None:
+                    done = True
+                    break
+                batch.append(job)
+
+            try:
+                if db is None:
+                    db = connect(self.db_path)
+                self._flush(db, batch)
+            except Exception as e:
+                self._stats["errors"] += 1
+                _logger.error("%s : could not write batch of %d: %s", self.db_path, len(batch), e)
+
+        if db is not None:
+            db.close()
+
+    def _transaction(self, db, batch):
+        # Immediate: take the write lock before anything is read,
+        # so statements that read-then-write (e.g. import offsets)
+        # can't race with another writer such as a Make import
+        db.execute("begin immediate")
+        try:
+            for fn, mark in batch:
+                fn(db)
+            db.execute("commit")
+        except:
+            db.execute("rollback")
+            raise
+
+    def _flush(self, db, batch):
+        t0 = time.monotonic()
+        committed = batch
+        try:
+            self._transaction(db, batch)
+        except Exception as e:
+            # One bad job should not lose the whole batch. Jobs can be any
+            # call (e.g. a file import), so anything they raise counts.
+            # Retry each job in its own transaction.
+            _logger.warning("%s : batch failed (%s), retrying one by one", self.db_path, e)
+            committed = []
+            for job in batch:
+                try:
+                    self._transaction(db, [job])
+                    committed.append(job)
+                except Exception as e:
+                    self._stats["errors"] += 1
+                    _logger.error("%s : could not write statement: %s", self.db_path, e)
+        elapsed_ms = (time.monotonic() - t0) * 1000
+
+        stats = self._stats
+        stats["batches"] += 1
+        stats["statements"] += len(batch)
+        stats["last_batch_size"] = len(batch)
+        stats["last_flush_ms"] = elapsed_ms
+        stats["max_flush_ms"] = max(stats["max_flush_ms"] or 0, elapsed_ms)
+        stats["total_flush_ms"] += elapsed_ms
+        _logger.debug("%s : flushed %d statements in %.1f ms", self.db_path, len(batch), elapsed_ms)
+
+        for mark in set(mark for fn, mark in committed if mark):
+            pathlib.Path(mark).touch()
+
+_writers = {}
+
+def writer(db_path, **kwargs):
+    """ Shared BatchWriter for db_path (one writer thread per process) """
+    if db_path not in _writers:
+        _writers[db_path] = BatchWriter(db_path, **kwargs)
+    return _writers[db_path]
@@ -1,5 +1,8 @@
+import collections
+import json
 import logging
 import os
+import threading
 
 _logger = logging.getLogger("seqfile")
 #_logger.setLevel(logging.DEBUG)
@@ -68,3 +71,318 @@ def choose_append_file(dir=".", match=('',''), size_limit=100*1024):
             _logger.info("%s : beginning new file. %s was over size threshold (%d / %d bytes)", target, prev, size, size_limit)
 
     return target
+
+class SequentialAppender:
+    """ Appends to the last file in a sequence, starting a new one when full
+
+        Keeps the current file open, and checks its size with an fstat
+        on the open fd, which also counts what other processes appended.
+        The directory is only scanned when (re)opening: on the first append,
+        after a fork, and when the current file crosses size_limit.
+    """
+
+    def __init__(self, dir=".", match=('',''), size_limit=100*1024):
+        self.dir = dir
+        self.match = match
+        self.size_limit = size_limit
+
+        self.target = None
+        self.index = None
+        self.offset = 0
+
+        self._f = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def path(self):
+        return "/".join([self.dir, self.target]) if self.target else None
+
+    def _open(self):
+        if self._f:
+            self._f.close()
+
+        # Re-check the directory rather than just incrementing the index,
+        # in case another process has already started the next file
+        os.makedirs(self.dir, exist_ok=True)
+        self.target = choose_append_file(self.dir, self.match, self.size_limit)
+        self.index = extract_sequence_number(self.target, self.match)
+
+        # Unbuffered, so each append is a single write() on an O_APPEND fd
+        # and lines from different processes do not interleave
+        self._f = open(self.path, "ab", buffering=0)
+        self.offset = self._f.tell()
+        self._pid = os.getpid()
+
+    def append(self, data):
+        """ Append data (str or bytes) and return (path, start, end) offsets """
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+
+        with self._lock:
+            if self._f is None or self._pid != os.getpid():
+                self._open()
+            else:
+                # Another process may have grown the file since our last append
+                size = os.fstat(self._f.fileno()).st_size
+                if size >= self.size_limit:
+                    _logger.info("%s : over size threshold (%d / %d bytes)", self.target, size, self.size_limit)
+                    self._open()
+
+            self._f.write(data)
+
+            # With O_APPEND, the position after the write is the end of the
+            # file, including anything other processes have appended
+            end = self._f.tell()
+            self.offset = end
+            return self.path, end - len(data), end
+
+    def close(self):
+        with self._lock:
+            if self._f:
+                self._f.close()
+            self._f = None
+
+class SequentialProgress:
+    """ Tracks the last file in a sequence directory and its size
+
+        Kept in memory and mirrored to a small JSON sidecar file, so that
+        checking progress costs one stat instead of listing the directory.
+        Other processes sharing the sidecar are picked up by its mtime.
+        The directory is only scanned if the sidecar does not exist yet.
+    """
+
+    def __init__(self, dir, sidecar, match=('','')):
+        self.dir = dir
+        self.sidecar = sidecar
+        self.match = match
+
+        self.last_file = None
+        self.size = None
+        self._sig = None
+        self._lock = threading.Lock()
+
+    def _scan(self):
+        files = os.listdir(self.dir)
+        last_file = last_file_in_sequence(files, self.match)
+        if last_file:
+            size = os.stat("/".join([self.dir, last_file]))[ST_SIZE_INDEX]
+        else:
+            size = None
+        _logger.info("%s : scanned directory for progress: %s %s", self.dir, last_file, size)
+        return last_file, size
+
+    def _load(self):
+        try:
+            st = os.stat(self.sidecar)
+        except FileNotFoundError:
+            self.last_file, self.size = self._scan()
+            self._save()
+            return
+
+        sig = (st.st_mtime_ns, st.st_size)
+        if sig == self._sig:
+            return
+
+        with open(self.sidecar) as f:
+            progress = json.load(f)
+        self.last_file = progress["last_file"]
+        self.size = progress["size"]
+        self._sig = sig
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.sidecar) or ".", exist_ok=True)
+        # Unique per thread too, for threaded servers (asgi.py)
+        tmp = "%s.%d.%d.tmp" % (self.sidecar, os.getpid(), threading.get_ident())
+        with open(tmp, "w") as f:
+            json.dump({"last_file": self.last_file, "size": self.size}, f)
+        os.replace(tmp, self.sidecar)
+        st = os.stat(self.sidecar)
+        self._sig = (st.st_mtime_ns, st.st_size)
+
+    def get(self):
+        """ Returns [last_file, size], or [None, None] for an empty directory """
+        with self._lock:
+            self._load()
+            return [self.last_file, self.size]
+
+    def update(self, filename, size):
+        """ Record that filename now has the given size """
+        with self._lock:
+            self._load()
+            if not filename.startswith(self.match[0]) or not filename.endswith(self.match[1]):
+                return
+            # Same ordering as last_file_in_sequence: plain sort order
+            if self.last_file is not None and filename < self.last_file:
+                return
+            if [filename, size] == [self.last_file, self.size]:
+                return
+            self.last_file = filename
+            self.size = size
+            self._save()
+
+class SequentialTail:
+    """ In-memory ring of the last lines appended to a file sequence
+
+        Lines this process appends are added as they are written
+        (see SequentialAppender.append for the offsets).
+        Lines other processes appended show up as a gap in the offsets,
+        and only that gap is read back from disk.
+
+        Other processes may still append to the previous file for a moment
+        after the sequence moves on, so its offset is kept as well, and
+        catch_up reads both before following any newer files by name.
+        Such late lines land in the ring after newer ones.
+    """
+
+    def __init__(self, maxlen=1000):
+        self.lines = collections.deque(maxlen=maxlen)
+        self.match = None
+        self.path = None
+        self.offset = 0
+        self.prev_path = None
+        self.prev_offset = 0
+        self._lock = threading.Lock()
+
+    def _read_lines(self, path, start, end=None):
+        with open(path, "rb") as f:
+            f.seek(start)
+            data = f.read() if end is None else f.read(end - start)
+        # Only take complete lines, in case another write is in progress
+        data = data[:data.rfind(b"\n")+1]
+        self._add_lines(data)
+        return start + len(data)
+
+    def _read_rest(self, path, offset):
+        """ Read any complete lines past offset, return the new offset """
+        try:
+            if os.stat(path)[ST_SIZE_INDEX] > offset:
+                return self._read_lines(path, offset)
+        except FileNotFoundError:
+            pass
+        return offset
+
+    def _add_lines(self, data):
+        text = data.decode("utf-8", errors="replace")
+        self.lines.extend(line for line in text.split("\n") if line)
+
+    def _add_at(self, path, offset, start, end, data):
+        """ Add data written to path between start and end, return the new offset """
+        if end <= offset:
+            # Already read from disk (e.g. when seeding)
+            return offset
+        if start > offset:
+            self._read_lines(path, offset, start)
+        self._add_lines(data)
+        return end
+
+    def _index(self, path):
+        return extract_sequence_number(os.path.basename(path), self.match)
+
+    def _next_path(self, path):
+        dir, name = os.path.split(path)
+        return "/".join([dir, next_sequence_filename(name, self.match)])
+
+    def _shift(self, path):
+        """ Make path the current file, after reading the rest of the old one """
+        if self.path:
+            self.offset = self._read_rest(self.path, self.offset)
+        self.prev_path, self.prev_offset = self.path, self.offset
+        self.path, self.offset = path, 0
+
+    def _move_to(self, path):
+        """ Follow the sequence forward to path
+
+            Returns False if path is older than the current file.
+        """
+        if self.path and self.match:
+            if self._index(path) < self._index(self.path):
+                return False
+            # Files other processes went through in between
+            next_path = self._next_path(self.path)
+            while next_path != path and os.path.exists(next_path):
+                self._shift(next_path)
+                next_path = self._next_path(next_path)
+        self._shift(path)
+        return True
+
+    def seed(self, dir=".", match=('',''), blocksize=8*1024):
+        """ Fill from the end of the last file in the sequence """
+        self.match = match
+        try:
+            files = os.listdir(dir)
+        except FileNotFoundError:
+            files = []
+        target = last_file_in_sequence(files, match)
+        if not target:
+            # Nothing written yet: follow the sequence from its first file
+            with self._lock:
+                self.lines.clear()
+                self.path = "/".join([dir, make_sequence_filename(0, match)])
+                self.offset = 0
+                self.prev_path = None
+                self.prev_offset = 0
+            return
+
+        path = "/".join([dir, target])
+        with open(path, "rb") as f:
+            size = f.seek(0, os.SEEK_END)
+            # Read backwards until we have enough lines or hit the start
+            start = size
+            data = b""
+            while start > 0 and data.count(b"\n") <= self.lines.maxlen:
+                start = max(0, start - blocksize)
+                f.seek(start)
+                data = f.read(size - start)
+
+        if start > 0:
+            # Drop the partial first line
+            data = data[data.index(b"\n")+1:]
+
+        with self._lock:
+            self.lines.clear()
+            self._add_lines(data)
+            self.path = path
+            self.offset = size
+            self.prev_path = None
+            self.prev_offset = 0
+
+    def add(self, path, start, end, data):
+        """ Add data that was written to path between start and end """
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+
+        with self._lock:
+            if path == self.prev_path:
+                # This process was still appending to the previous file
+                self.prev_offset = self._add_at(path, self.prev_offset, start, end, data)
+                return
+
+            if path != self.path and not self._move_to(path):
+                # Older than anything tracked: keep the line, not the offset
+                self._add_lines(data)
+                return
+
+            self.offset = self._add_at(path, self.offset, start, end, data)
+
+    def catch_up(self):
+        """ Read any lines other processes appended to the sequence """
+        with self._lock:
+            if not self.path:
+                return
+            if self.prev_path:
+                self.prev_offset = self._read_rest(self.prev_path, self.prev_offset)
+            self.offset = self._read_rest(self.path, self.offset)
+
+            if self.match:
+                # Files other processes have started since
+                next_path = self._next_path(self.path)
+                while os.path.exists(next_path):
+                    self._shift(next_path)
+                    self.offset = self._read_rest(next_path, 0)
+                    next_path = self._next_path(next_path)
+
+    def last(self, n):
+        with self._lock:
+            n = max(0, min(n, len(self.lines)))
+            return [self.lines[i] for i in range(len(self.lines)-n, len(self.lines))]
@@ -2,20 +2,27 @@
 
 import argparse
 import datetime
+import fcntl
+import fnmatch
+import hashlib
+import importlib
 import io
+import json
 import logging
 import os
-import pathlib
 import sqlite3
-import subprocess
+import sys
+import threading
 import time
 
+# Only light imports here: uWSGI workers import this module on every
+# (re)spawn, and the ingest endpoints need nothing more.
+# Anything heavy is imported on first use (see readings_importer).
 import flask
 import flask_restful
-import json2table
-import pandas as pd
-import numpy as np
 
+import co2query
+import dbwriter
 import seqfile
 
 # Command-Line Argument Parsing
@@ -32,11 +39,216 @@ def build_parser():
 # Helpers
 #=================================================================
 
-def prep_append_file(dir=".", match=('',''), size_limit=100*1024):
-    os.makedirs(dir, exist_ok=True)
-    target = seqfile.choose_append_file(dir, match, size_limit)
-    tpath = "/".join([dir, target])
-    return tpath
+_appenders = {}
+
+def sequential_appender(dir=".", match=('',''), size_limit=100*1024):
+    key = (dir, match)
+    if key not in _appenders:
+        _appenders[key] = seqfile.SequentialAppender(dir, match, size_limit)
+    return _appenders[key]
+
+def write_stream_at(stream, fd, offset, length=None, bufsize=64*1024, known_size=0):
+    """ Copy a request body stream into fd at offset, bufsize at a time
+
+        Returns (bytes written, bytes skipped).
+        If length is None, reads until the stream is exhausted.
+
+        Parts of the body that fall within the first known_size bytes of
+        the file are compared with what is already there, and only written
+        if different. Units often resend chunks the server already has,
+        and reading them back (usually from the page cache) is cheaper
+        than rewriting them.
+    """
+    written = 0
+    skipped = 0
+    pos = offset
+    while length is None or pos - offset < length:
+        want = bufsize if length is None else min(bufsize, length - (pos - offset))
+        chunk = stream.read(want)
+        if not chunk:
+            break
+        if pos + len(chunk) <= known_size and os.pread(fd, len(chunk), pos) == chunk:
+            skipped += len(chunk)
+        else:
+            # pwrite does not move the file position or need a seek,
+            # and writing past the end of the file fills the gap with zeros
+            os.pwrite(fd, chunk, pos)
+            written += len(chunk)
+        pos += len(chunk)
+    return written, skipped
+
+# Counters for pushes in this process, see /status/push
+_push_stats = {}
+_push_stats_pid = None
+_push_stats_lock = threading.Lock()
+
+def _push_counters():
+    """ This process's push counters. Call with _push_stats_lock held. """
+    global _push_stats_pid
+    if _push_stats_pid != os.getpid():
+        # New (or forked) process: start counting afresh
+        _push_stats.clear()
+        _push_stats.update({
+                "writes": 0,
+                "bytes_written": 0,
+                "duplicate_chunks": 0,  # pushes with nothing new, not written at all
+                "duplicate_bytes": 0,   # bytes already on disk, not rewritten
+                "lock_contended": 0,
+                "total_lock_wait_ms": 0.0,
+                "max_lock_wait_ms": 0.0,
+        })
+        _push_stats_pid = os.getpid()
+    return _push_stats
+
+def count_push(written, skipped):
+    with _push_stats_lock:
+        stats = _push_counters()
+        if written:
+            stats["writes"] += 1
+            stats["bytes_written"] += written
+        elif skipped:
+            stats["duplicate_chunks"] += 1
+        stats["duplicate_bytes"] += skipped
+
+def lock_file(fd):
+    """ Take an exclusive lock on an open file, waiting if needed
+
+        flock locks belong to the open file, so this serializes writers of
+        one file across uWSGI workers and threads alike, while writers of
+        other files go on in parallel. The lock is released on close.
+    """
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return
+    except BlockingIOError:
+        pass
+    t0 = time.monotonic()
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    wait_ms = (time.monotonic() - t0) * 1000
+    with _push_stats_lock:
+        stats = _push_counters()
+        stats["lock_contended"] += 1
+        stats["total_lock_wait_ms"] += wait_ms
+        stats["max_lock_wait_ms"] = max(stats["max_lock_wait_ms"], wait_ms)
+
+def push_stats():
+    with _push_stats_lock:
+        stats = dict(_push_counters())
+    stats["pid"] = os.getpid()
+    total_ms = stats.pop("total_lock_wait_ms")
+    stats["mean_lock_wait_ms"] = total_ms / stats["lock_contended"] if stats["lock_contended"] else None
+    return stats
+
+_recent_pings = None
+
+def recent_pings():
+    """ Ring of the most recent ping lines, seeded from disk on first use """
+    global _recent_pings
+    if _recent_pings is None:
+        config = flask.current_app.config
+        alive_dir = flask.safe_join(config["SERVER_VAR_DIR"], "pings")
+        tail = seqfile.SequentialTail(maxlen=config["RECENT_PINGS_MAX"])
+        tail.seed(alive_dir, match=("pings-", ".tsv"))
+        _recent_pings = tail
+    return _recent_pings
+
+def db_writer():
+    config = flask.current_app.config
+    return dbwriter.writer(config["DB_PATH"],
+            batch_size=config["DB_BATCH_SIZE"],
+            flush_interval=config["DB_FLUSH_INTERVAL"])
+
+def create_units_last_seen(db):
+    """ Create the units_last_seen table, seeded from unit_ping_days if present """
+    tables = set(r[0] for r in db.execute("select name from sqlite_master where type = 'table'"))
+    if "units_last_seen" in tables:
+        return
+    db.execute("""
+        create table units_last_seen (
+            unit_id     TEXT primary key,
+            last_ts     TEXT,
+            nickname    TEXT,
+            rssi_raw    INTEGER,
+            rssi_dbm    INTEGER
+        );
+    """)
+    if "unit_ping_days" in tables:
+        # Per-day ping stats kept by ../database/python/import_pings.py
+        db.execute("""
+            insert into units_last_seen (unit_id, last_ts, nickname, rssi_dbm)
+            select unit_id, max(ping_date) || 'T' || last_time, last_nickname, last_dbm
+            from unit_ping_days
+            group by unit_id
+        """)
+
+_last_seen_pid = None
+
+def queue_last_seen(sqlrow):
+    """ Have the db writer record a ping in units_last_seen """
+    global _last_seen_pid
+    writer = db_writer()
+    if _last_seen_pid != os.getpid():
+        # Once per worker. Queued first, so it runs before the upsert.
+        writer.submit_call(create_units_last_seen)
+        _last_seen_pid = os.getpid()
+    # Pings from different workers can commit out of order,
+    # so never replace a newer ping with an older one
+    writer.submit("""
+        insert into units_last_seen (unit_id, last_ts, nickname, rssi_raw, rssi_dbm)
+        values (:unit_id, :ping_iso, :nickname, :rssi_raw, :rssi_dbm)
+        on conflict (unit_id) do update set
+            last_ts = excluded.last_ts,
+            nickname = excluded.nickname,
+            rssi_raw = excluded.rssi_raw,
+            rssi_dbm = excluded.rssi_dbm
+        where excluded.last_ts >= units_last_seen.last_ts
+    """, sqlrow)
+
+def units_last_seen():
+    """ Last ping of every unit, ordered by nickname then unit ID """
+    db = dbwriter.connection(flask.current_app.config["DB_PATH"])
+    try:
+        cur = db.execute("""
+            select unit_id, last_ts, nickname, rssi_raw, rssi_dbm
+            from units_last_seen
+            order by nickname, unit_id
+        """)
+    except sqlite3.OperationalError:
+        # No pings since the table was introduced
+        return []
+    cols = [c[0] for c in cur.description]
+    return [dict(zip(cols, row)) for row in cur]
+
+_readings_importer = None
+
+def readings_importer():
+    """ The database scripts' CO2 readings importer, loaded on first use """
+    global _readings_importer
+    if _readings_importer is None:
+        sys.path.insert(0, flask.current_app.config["DATABASE_PYTHON_DIR"])
+        _readings_importer = importlib.import_module("import_co2_readings")
+    return _readings_importer
+
+def queue_readings_ingest(localpath, final=False):
+    """ Have the db writer import any new complete lines in a readings file
+
+        If final, the file will not grow any more, so a last line
+        without a newline is imported too.
+
+        Make's import marker is not touched: the pushed files stay newer
+        than it, so the next Make import still runs and picks up anything
+        skipped here (e.g. before its importer has set up the tables).
+        What the server already imported is skipped by its offsets.
+    """
+    importer = readings_importer()
+
+    def ingest(db):
+        # Leave the tables to Make until its importer has set them up
+        # (and rebuilt or migrated them, if made by older import scripts)
+        if importer.is_set_up(db):
+            importer.import_file(db, localpath, final)
+
+    db_writer().submit_call(ingest)
 
 # Flask
 #=================================================================
@@ -54,8 +266,21 @@ app = flask.Flask(__name__,
         static_folder="../var/pub")
 app.config['REMOTE_DATA_DIR'] = "../remote_data"
 app.config['SERVER_VAR_DIR'] = "../var"
+app.config['PUSH_PROGRESS_DIR'] = "../var/push_progress"
+app.config['PUSH_BUFFER_SIZE'] = 64 * 1024  # bytes held in memory per upload
+app.config['RECENT_PINGS_MAX'] = 1000       # ping lines kept in memory for status
 app.config['DB_PATH'] = "../var/db.sqlite3"
 app.config['DB_PING_MARK_FILE'] = "../var/.mark_db_load_pings"
+app.config['DB_BATCH_SIZE'] = 200           # max statements per commit
+app.config['DB_FLUSH_INTERVAL'] = 1.0       # max seconds a ping waits for commit
+app.config['ASGI_THREADS'] = 8              # request handler threads under asgi.py
+app.config['ASGI_MAX_BODY_SIZE'] = 16 * 1024 * 1024  # larger uploads get a 413 under asgi.py
+
+# Optional: import pushed CO2 readings into the database as they arrive,
+# instead of waiting for the periodic Make import
+app.config['INGEST_READINGS'] = False
+app.config['INGEST_READINGS_GLOB'] = "data/readings/readings-*.tsv"
+app.config['DATABASE_PYTHON_DIR'] = "../database/python"
 
 class HelloWorld(flask_restful.Resource):
     def get(self):
@@ -73,13 +298,14 @@ class OuAlive(flask_restful.Resource):
 
         var_dir = flask.current_app.config["SERVER_VAR_DIR"]
         alive_dir = flask.safe_join(var_dir, "pings")
-        target = prep_append_file(dir=alive_dir, match=("pings-", ".tsv"))
-        with open(target, "at") as f:
-            f.write("\t".join(row))
-            f.write("\n")
+        appender = sequential_appender(dir=alive_dir, match=("pings-", ".tsv"))
+        line = "\t".join(row) + "\n"
+        path, start, end = appender.append(line)
+        recent_pings().add(path, start, end, line)
 
         try:
             sqlrow = {
+                    "ping_ts": tiso[:len("2019-09-17T16:37:12")],
                     "ping_date": tiso[:len("2019-09-17")],
                     "ping_time": tiso[len("2019-09-17T"):],
                     "unit_id": ou_id,
@@ -87,14 +313,12 @@ class OuAlive(flask_restful.Resource):
                     "rssi_raw": args["rssi_raw"] if "rssi_raw" in args else None,
                     "rssi_dbm": args["rssi_dbm"] if "rssi_dbm" in args else None,
             }
-            db_path = flask.current_app.config["DB_PATH"]
-            db = sqlite3.connect(db_path)
-            with db:
-                db.execute("insert into pings values (:ping_date, :ping_time, :unit_id, :nickname, :rssi_raw, :rssi_dbm);", sqlrow)
-            db.close()
-
-            # Mark pings as updated
-            pathlib.Path(flask.current_app.config["DB_PING_MARK_FILE"]).touch()
+            # Queued for the background writer, which commits pings in
+            # batches and marks pings as updated after each commit
+            db_writer().submit("insert or ignore into pings (ping_ts, ping_date, ping_time, unit_id, nickname, rssi_raw, rssi_dbm) values (:ping_ts, :ping_date, :ping_time, :unit_id, :nickname, :rssi_raw, :rssi_dbm);", sqlrow,
+                    mark=flask.current_app.config["DB_PING_MARK_FILE"])
+            sqlrow["ping_iso"] = tiso
+            queue_last_seen(sqlrow)
         except Exception as e:
             print("Could not add ping to database:", e)
 
@@ -102,55 +326,70 @@ class OuAlive(flask_restful.Resource):
 
 class StatusAliveRecent(flask_restful.Resource):
     def get(self):
-        var_dir = flask.current_app.config["SERVER_VAR_DIR"]
-        alive_dir = flask.safe_join(var_dir, "pings")
-        dirlist = sorted(os.listdir(alive_dir))
-        target = seqfile.last_file_in_sequence(dirlist, match=("pings-", ".tsv"))
-        target = flask.safe_join(alive_dir, target)
-        if not target:
+        tail = recent_pings()
+        tail.catch_up()
+
+        args = flask.request.args
+        asc = args["asc"] in ["true","True","1"] if "asc" in args else False
+        refresh = args["refresh"] if "refresh" in args else None
+        try:
+            n = int(args["n"]) if "n" in args else 20
+        except ValueError:
+            n = 20
+
+        lines = tail.last(n)
+        if not lines:
             return "No recent pings"
-        else:
-            args = flask.request.args
-            asc = args["asc"] in ["true","True","1"] if "asc" in args else False
-            refresh = args["refresh"] if "refresh" in args else None
-
-            tailproc = subprocess.run(["tail", "-n", "20", target], stdout=subprocess.PIPE)
-            lines = tailproc.stdout.decode("utf-8").strip().split("\n")
-
-            tiso = datetime.datetime.utcnow().isoformat()
-            lines.append("{}\t(now)".format(tiso))
-
-            if not asc:
-                lines = list(reversed(lines))
-
-            for i,line in enumerate(lines):
-                # Strip sub-seconds from timestampe
-                line = line[:len("2019-09-17T16:37:12")] + line[len("2019-09-17T16:37:12.455629"):]
-                # Strip "co2unit-" part
-                line = line.replace("\tco2unit-", "\t")
-                lines[i] = line
-
-            resp = flask.Response("\n".join(lines), mimetype="text/plain")
-
-            if refresh:
-                try:
-                    refresh = int(refresh)
-                    resp.headers["Refresh"] = refresh
-                except:
-                    pass
-
-            return resp
-
-def sequential_dir_progress(localdir):
-    files = os.listdir(localdir)
-    files.sort()
-    lastfile = seqfile.last_file_in_sequence(files)
-    if lastfile:
-        lastpath = flask.safe_join(localdir, lastfile)
-        size = os.stat(lastpath)[6]
-        return [lastfile, size]
-    else:
-        return [None, None]
+
+        tiso = datetime.datetime.utcnow().isoformat()
+        lines.append("{}\t(now)".format(tiso))
+
+        if not asc:
+            lines = list(reversed(lines))
+
+        for i,line in enumerate(lines):
+            # Strip sub-seconds from timestampe
+            line = line[:len("2019-09-17T16:37:12")] + line[len("2019-09-17T16:37:12.455629"):]
+            # Strip "co2unit-" part
+            line = line.replace("\tco2unit-", "\t")
+            lines[i] = line
+
+        resp = flask.Response("\n".join(lines), mimetype="text/plain")
+
+        if refresh:
+            try:
+                refresh = int(refresh)
+                resp.headers["Refresh"] = refresh
+            except:
+                pass
+
+        return resp
+
+class StatusAliveLastSeen(flask_restful.Resource):
+    def get(self):
+        return units_last_seen()
+
+class StatusAliveLastSeenTsv(flask_restful.Resource):
+    def get(self):
+        # Same columns as the old scripts/units-last-seen.sh:
+        # nickname, last ping time, unit ID
+        lines = []
+        for unit in units_last_seen():
+            ts = unit["last_ts"] or ""
+            ts = ts[:len("2019-09-17")] + " " + ts[len("2019-09-17T"):len("2019-09-17T16:37:12")]
+            lines.append("\t".join([str(unit["nickname"]), ts, unit["unit_id"]]))
+        return flask.Response("".join(l + "\n" for l in lines), mimetype="text/tab-separated-values")
+
+_progress = {}
+
+def sequential_progress(ou_id, dirpath):
+    """ Cached SequentialProgress for one unit's data directory """
+    config = flask.current_app.config
+    localdir = flask.safe_join(config["REMOTE_DATA_DIR"], ou_id, dirpath)
+    if localdir not in _progress:
+        sidecar = flask.safe_join(config["PUSH_PROGRESS_DIR"], ou_id, dirpath, "progress.json")
+        _progress[localdir] = seqfile.SequentialProgress(localdir, sidecar)
+    return _progress[localdir]
 
 class OuPush(flask_restful.Resource):
     def get(self, ou_id, filepath):
@@ -158,8 +397,8 @@ class OuPush(flask_restful.Resource):
         print(flask.request.data)
 
     def put(self, ou_id, filepath):
-        data_dir = flask.current_app.config["REMOTE_DATA_DIR"]
-        data = flask.request.data
+        config = flask.current_app.config
+        data_dir = config["REMOTE_DATA_DIR"]
         offset = int(flask.request.args["offset"])
 
         localpath = flask.safe_join(data_dir, ou_id, filepath)
@@ -168,49 +407,151 @@ class OuPush(flask_restful.Resource):
 
         # Make sure everything exists
         os.makedirs(localdir, exist_ok=True)
-        if not os.path.isfile(localpath):
-            with open(localpath, "w"):
-                pass
 
-        # Make sure we're not skipping part of a file
-        lastfile, lastsize = sequential_dir_progress(localdir)
-        if lastfile == localfile and offset > lastsize + 1:
-            return {
-                    "error": "SKIPPED_PART_OF_FILE",
-                    "ack_file": [lastfile, lastsize, lastsize],
-                    }, 416
+        progress = sequential_progress(ou_id, os.path.dirname(filepath))
 
-        # On file modes:
+        # On file flags:
         #
-        # a will force append to the end of the file.
-        # w will truncate the file.
-        # r+ allows reading and seeking.
-        #
-        # So r+ is what we need, but it throws an error if the file doesn't
-        # exist, so create it first.
-
-        with open(localpath, "r+b") as f:
-            # Note: seeking past the end of the file and then writing will fill the gap with zeros
-            f.seek(offset)
-            f.write(data)
-
-        lastfile, lastsize = sequential_dir_progress(localdir)
+        # O_CREAT creates the file if it doesn't exist.
+        # No O_TRUNC, because we are writing into the middle of the file.
+        # No O_APPEND, because that would force writes to the end.
+        fd = os.open(localpath, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # One writer per file at a time, so retransmissions of the same
+            # chunk cannot interleave. Size and progress are read under the lock.
+            lock_file(fd)
+            prev_lastfile, _ = progress.get()
+
+            # The file we just opened may be new, and so the new last file
+            size = os.fstat(fd).st_size
+            progress.update(localfile, size)
+
+            # Make sure we're not skipping part of a file
+            lastfile, lastsize = progress.get()
+            if lastfile == localfile and offset > lastsize + 1:
+                return {
+                        "error": "SKIPPED_PART_OF_FILE",
+                        "ack_file": [lastfile, lastsize, lastsize],
+                        }, 416
+
+            # Stream the body straight to the file rather than reading it
+            # all into memory first, so memory stays flat for large chunks.
+            # Resent data that is already on disk is not written again.
+            written, skipped = write_stream_at(flask.request.stream, fd, offset,
+                    length=flask.request.content_length,
+                    bufsize=config["PUSH_BUFFER_SIZE"],
+                    known_size=size)
+            count_push(written, skipped)
+
+            if written:
+                progress.update(localfile, os.fstat(fd).st_size)
+                lastfile, lastsize = progress.get()
+        finally:
+            os.close(fd)
+
+        if config["INGEST_READINGS"] and fnmatch.fnmatch(filepath, config["INGEST_READINGS_GLOB"]):
+            prev_filepath = os.path.join(os.path.dirname(filepath), prev_lastfile or "")
+            if prev_lastfile is not None and prev_lastfile < localfile \
+                    and fnmatch.fnmatch(prev_filepath, config["INGEST_READINGS_GLOB"]):
+                # The unit moved on to a new file, so the previous one is
+                # complete, even if its last line has no newline
+                queue_readings_ingest(os.path.join(localdir, prev_lastfile), final=True)
+            if written:
+                # Only the last file in the sequence can still grow
+                queue_readings_ingest(localpath, final=(lastfile != localfile))
         return {
                 "ack_file": [lastfile, lastsize, lastsize],
             }
 
-def find_files(topdir):
-    for dpath, dirnames, fnames in os.walk(topdir):
-        for fname in fnames:
-            yield "/".join([dpath,fname])
+# Pulled files and listings are cached with content-hash ETags,
+# checked against mtimes, so polling units that already have the
+# latest updates get a 304 without the tree being walked or hashed again
+
+_listings = {}
+_file_etags = {}
+
+def hash_etag(chunks):
+    h = hashlib.sha1()
+    for chunk in chunks:
+        h.update(chunk)
+    return h.hexdigest()
 
-def strip_prefix(prefix, str_iter):
-    for s in str_iter:
-        if not s.startswith(prefix):
-            raise Exception("No prefix: {} does not start with {}".format(s, prefix))
-        yield s[len(prefix):]
+def scan_dir(topdir, recursive):
+    """ Returns (listing as OuPull serves it, {directory: mtime_ns})
+
+        Same order as os.listdir, or os.walk (top-down) if recursive.
+        Each directory's mtime is taken before it is listed, so a change
+        during the scan shows up as a changed mtime next time.
+    """
+    mtimes = {}
+    listing = []
+
+    def scan(dpath):
+        try:
+            mtimes[dpath] = os.stat(dpath).st_mtime_ns
+            entries = list(os.scandir(dpath))
+        except OSError:
+            # Skipped, like os.walk does
+            return
+        if not recursive:
+            listing.extend(e.name for e in entries)
+            return
+        subdirs = []
+        for e in entries:
+            try:
+                is_dir = e.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                if not e.is_symlink():
+                    subdirs.append(e.path)
+            else:
+                listing.append(e.path[len(topdir)+1:])
+        for subdir in subdirs:
+            scan(subdir)
+
+    scan(topdir)
+    return listing, mtimes
+
+def list_dir(localpath, recursive):
+    """ Cached directory listing and its ETag
+
+        Reused while every listed directory has the same mtime.
+        Adding, removing or renaming a file (or subdirectory)
+        changes the mtime of the directory it is in.
+    """
+    key = (localpath, recursive)
+    if key in _listings:
+        listing, mtimes, etag = _listings[key]
+        try:
+            if all(os.stat(d).st_mtime_ns == m for d, m in mtimes.items()):
+                return listing, etag
+        except OSError:
+            pass
+    listing, mtimes = scan_dir(localpath, recursive)
+    etag = hash_etag([json.dumps(listing).encode()])
+    _listings[key] = listing, mtimes, etag
+    return listing, etag
+
+def file_etag(localpath):
+    """ Hash of a file's contents, cached while its mtime and size are unchanged """
+    with open(localpath, "rb") as f:
+        st = os.fstat(f.fileno())
+        sig = (st.st_mtime_ns, st.st_size)
+        cached = _file_etags.get(localpath)
+        if cached and cached[0] == sig:
+            return cached[1]
+        etag = hash_etag(iter(lambda: f.read(64 * 1024), b""))
+    _file_etags[localpath] = sig, etag
+    return etag
 
 class OuPull(flask_restful.Resource):
+    """ Files (updates) for units to download
+
+        Responses have ETags, so units can poll with If-None-Match
+        and get a 304 if nothing changed.
+        Files can be resumed with Range requests.
+    """
     def get(self, ou_id, filepath):
         data_dir = flask.current_app.config["REMOTE_DATA_DIR"]
         localpath = flask.safe_join(data_dir, ou_id, filepath)
@@ -225,21 +566,32 @@ class OuPull(flask_restful.Resource):
         if not firstsegment in whitelist: flask.abort(404)
 
         if os.path.isdir(localpath):
-            if not recursive:
-                return os.listdir(localpath)
-            else:
-                prefix = localpath + "/"
-                fpaths = strip_prefix(prefix, find_files(localpath))
-                return list(fpaths)
+            listing, etag = list_dir(localpath, recursive)
+            resp = api.make_response(listing, 200)
+            resp.set_etag(etag)
+            return resp.make_conditional(flask.request)
 
         elif os.path.isfile(localpath):
-            fname = os.path.basename(localpath)
-            f = open(localpath, "rb")
-            return flask.send_file(f, attachment_filename=fname)
+            etag = file_etag(localpath)
+            # Given the path, Flask opens the file itself and closes it when done
+            resp = flask.send_file(localpath, add_etags=False, conditional=False)
+            resp.set_etag(etag)
+            resp.headers["Accept-Ranges"] = "bytes"
+            return resp.make_conditional(flask.request,
+                    accept_ranges=True, complete_length=resp.content_length)
 
         else:
             flask.abort(404)
 
+class StatusDbWriter(flask_restful.Resource):
+    def get(self):
+        return db_writer().stats()
+
+class StatusPush(flask_restful.Resource):
+    def get(self):
+        # Per process: each uWSGI worker keeps its own counts
+        return push_stats()
+
 status_alive_refresh = 60 * 10
 
 class StatusAliveSummary(flask_restful.Resource):
@@ -266,6 +618,47 @@ class DataCo2Static(flask_restful.Resource):
         resp = flask.send_from_directory(flask.current_app.static_folder, path, cache_timeout=data_co2_refresh-10)
         return resp
 
+class DataCo2Unit(flask_restful.Resource):
+    """ Bucketed CO2 readings for one unit
+
+        Query parameters:
+            from, to    ISO date/datetime, UTC (default: the last 7 days)
+            bucket      bucket size, e.g. 15min, 1h, 1d (default 1h)
+            format      jsonl or csv (default jsonl)
+    """
+    def get(self, unit_id):
+        # Same URL space as the static files built by Make
+        # (unit IDs never have a dot, file names do)
+        static_path = flask.safe_join(flask.current_app.static_folder, unit_id)
+        if "." in unit_id or os.path.exists(static_path):
+            return DataCo2Static().get(unit_id)
+
+        args = flask.request.args
+        try:
+            end = co2query.parse_time(args["to"]) if "to" in args else datetime.datetime.utcnow()
+            start = co2query.parse_time(args["from"]) if "from" in args \
+                    else end - datetime.timedelta(days=7)
+            bucket_secs = co2query.parse_bucket(args.get("bucket", "1h"))
+        except ValueError as e:
+            flask.abort(400, str(e))
+        fmt = args.get("format", "jsonl")
+        if fmt not in co2query.formats:
+            flask.abort(400, "format must be one of: {}".format(", ".join(co2query.formats)))
+        if end <= start:
+            flask.abort(400, "'to' must be after 'from'")
+
+        db = dbwriter.connection(flask.current_app.config["DB_PATH"])
+        try:
+            rows = co2query.select_buckets(db, unit_id, start, end, bucket_secs)
+        except sqlite3.OperationalError as e:
+            # No readings imported yet
+            flask.current_app.logger.warning("%s : CO2 query failed: %s", unit_id, e)
+            flask.abort(404)
+
+        # Stream rows as SQLite produces them
+        lines, mimetype = co2query.formats[fmt]
+        return flask.Response(lines(rows), mimetype=mimetype)
+
 api = flask_restful.Api(app)
 api.add_resource(HelloWorld, "/")
 api.add_resource(OuAlive, "/ou/<string:ou_id>/alive")
@@ -273,12 +666,17 @@ api.add_resource(OuPush, "/ou/<string:ou_id>/push-sequential/<path:filepath>")
 api.add_resource(OuPull, "/ou/<string:ou_id>/<path:filepath>")
 
 api.add_resource(StatusAliveRecent, "/status/alive/recent")
+api.add_resource(StatusAliveLastSeen, "/status/alive/last-seen")
+api.add_resource(StatusAliveLastSeenTsv, "/status/alive/last-seen.tsv")
+api.add_resource(StatusDbWriter, "/status/db/writer")
+api.add_resource(StatusPush, "/status/push")
 
 # Additional semi-static resources built externally by Make
 # (See ../database/Makefile)
 api.add_resource(StatusAliveSummary, "/status/alive/summary")
 api.add_resource(StatusAliveStatic, "/status/alive/<path:path>")
 api.add_resource(DataCo2Summary, "/data/co2/summary")
+api.add_resource(DataCo2Unit, "/data/co2/<string:unit_id>")
 api.add_resource(DataCo2Static, "/data/co2/<path:path>")
 
 # Main